@@ -0,0 +1,65 @@
+import asyncio  # Импорт модуля для работы с асинхронностью
+import sqlite3  # Импорт модуля для работы с SQLite базой данных
+from concurrent.futures import ThreadPoolExecutor  # Выделенный поток для запросов к базе
+
+
+class Database:
+    """Асинхронный доступ к SQLite через одно долгоживущее соединение на выделенном потоке.
+
+    Все запросы выполняются последовательно в потоке "db", поэтому event loop
+    (Discord и Telegram) никогда не ждёт диск. Каждый вызов run() — одна транзакция.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    def _connection(self):
+        # Соединение создаётся лениво и живёт столько же, сколько поток базы
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")  # читатели (web-app, sync.py) не блокируют запись
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA busy_timeout = 5000")
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, func, args):
+        conn = self._connection()
+        with conn:  # commit при успехе, rollback при исключении
+            return func(conn, *args)
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке базы в рамках одной транзакции"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, func, args)
+
+    def run_blocking(self, func, *args):
+        """То же, что run(), но синхронно — для инициализации до запуска event loop"""
+        return self._executor.submit(self._transaction, func, args).result()
+
+    async def execute(self, query, params=()):
+        """Выполняет запрос на запись и возвращает lastrowid"""
+        return await self.run(lambda conn: conn.execute(query, params).lastrowid)
+
+    async def executemany(self, query, seq_of_params):
+        """Выполняет запрос для каждого набора параметров и возвращает число изменённых строк"""
+        return await self.run(lambda conn: conn.executemany(query, seq_of_params).rowcount)
+
+    async def fetchone(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchone())
+
+    async def fetchall(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchall())
+
+    def close(self):
+        """Закрывает соединение и останавливает поток базы"""
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close).result()
+        self._executor.shutdown(wait=True)
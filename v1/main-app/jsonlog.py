@@ -0,0 +1,78 @@
+import contextvars
+import gzip
+import json  # Импорт модуля для работы с JSON
+import logging  # Импорт модуля логирования
+import os
+import queue
+import shutil
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Поля текущей команды (command, user, guild) — добавляются ко всем записям, сделанным во время её выполнения
+log_context = contextvars.ContextVar("log_context", default=None)
+
+CONTEXT_FIELDS = ("command", "user", "guild", "latency_ms")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: ts, level, logger, message и поля контекста команды"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextQueueHandler(QueueHandler):
+    """QueueHandler, который сохраняет traceback отдельно от текста и добавляет контекст команды"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        for field, value in (log_context.get() or {}).items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        # Всё, что нельзя передать между потоками, превращаем в строки здесь
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=5 * 1024 * 1024, backup_count=10):
+    """Направляет корневой логгер в очередь; запись в файл (JSON lines, ротация с gzip) идёт в отдельном потоке.
+
+    Возвращает запущенный QueueListener — его нужно остановить при завершении, чтобы дописать очередь.
+    """
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(ContextQueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -3,16 +3,28 @@ from discord.ext import commands  # Импорт расширения для к
 import json  # Импорт модуля для работы с JSON
 import logging  # Импорт модуля логирования
 import os  # Импорт модуля для работы с операционной системой
-import sqlite3  # Импорт модуля для работы с SQLite базой данных
 from datetime import datetime, timedelta  # Импорт классов для работы с датой и временем
 from dotenv import load_dotenv  # Импорт функции для загрузки переменных окружения из файла .env
 import asyncio
+import csv
+import heapq
+import io
+import time
+import typing
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
 from discord.ui import View, Button, Modal, TextInput
 import secrets
 import aiohttp
 from aiogram import Bot as TelegramBot, Dispatcher, types, Router
 from aiogram.filters.command import Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from db import Database  # Асинхронный слой доступа к SQLite
+from jsonlog import log_context, setup_logging  # Логи в формате JSON lines через очередь
+from migrations import migrate  # Версионированные миграции схемы
+from ratelimit import TokenBucket  # Ограничение частоты отправки
 
 # Загрузка переменных окружения из файла .env (убедитесь, что файл .env добавлен в .gitignore)
 load_dotenv()
@@ -26,9 +38,8 @@ if not DISCORD_TOKEN:
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения")
 
-# Настройка логирования: все логи записываются в файл 'bot.json'
-logging.basicConfig(filename='../bot.json', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# Настройка логирования: записи в формате JSON lines пишутся в 'bot.json' из отдельного потока
+log_listener = setup_logging('../bot.json')
 
 # Загрузка настроек из файла config.json (без токена)
 config_file_path = "../config.json"
@@ -49,6 +60,8 @@ LOG_ALL_CHANNEL_ID = config["LOG_ALL_CHANNEL_ID"]  # ID канала, куда 
 # Инициализация Telegram бота
 telegram_bot = TelegramBot(
     token=TELEGRAM_TOKEN,
+    # Одна HTTP-сессия на все запросы; пул соединений рассчитан на параллельную рассылку
+    session=AiohttpSession(limit=config.get("TELEGRAM_CONNECTIONS", 30)),
     default=DefaultBotProperties(parse_mode="HTML")
 )
 
@@ -64,10 +77,100 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
+class Bot(commands.Bot):
+    async def close(self):
+        # Буферизованные логи дописываются, пока соединение с Discord ещё открыто
+        for writer in log_writers:
+            await writer.flush()
+        await super().close()
+
 # Создание экземпляра бота с префиксом "!" и заданными намерениями
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = Bot(command_prefix="!", intents=intents)
 bot.remove_command("help")
+
+# ==============================
+# Буферизованная запись в лог-каналы
+# ==============================
+class ChannelLogWriter:
+    """Собирает записи для лог-канала и отправляет их пачками — одно сообщение вместо сообщения на каждый клик.
+
+    Пачка уходит, когда набралось около limit символов или прошло interval секунд; порядок записей сохраняется.
+    """
+
+    def __init__(self, channel_id, limit=1900, interval=3.0):
+        self.channel_id = channel_id
+        self.limit = limit
+        self.interval = interval
+        self.entries = 0
+        self.batches = 0
+        self.dropped = 0
+        self._missing_reported = False
+        self._pending = deque()
+        self._size = 0
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def write(self, text):
+        """Добавляет запись в буфер (без обращения к Discord)"""
+        if len(text) > self.limit:
+            text = text[:self.limit - 1] + "…"
+        self._pending.append(text)
+        self._size += len(text) + 1
+        self.entries += 1
+        if self._size >= self.limit:
+            self._full.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def _next_batch(self):
+        batch, size = [], 0
+        while self._pending and size + len(self._pending[0]) + 1 <= self.limit + 1:
+            text = self._pending.popleft()
+            self._size -= len(text) + 1
+            size += len(text) + 1
+            batch.append(text)
+        return "\n".join(batch)
+
+    async def flush(self):
+        """Отправляет всё накопленное; пачки уходят строго по очереди"""
+        async with self._lock:
+            channel = bot.get_channel(self.channel_id)
+            if channel is None:
+                # Неверный ID или удалённый канал: записи отбрасываем, иначе буфер растёт всё время работы бота
+                if not self._missing_reported:
+                    logging.error(f"Лог-канал {self.channel_id} не найден — записи для него отбрасываются")
+                    self._missing_reported = True
+                self.dropped += len(self._pending)
+                self._pending.clear()
+                self._size = 0
+                return
+            self._missing_reported = False
+            while self._pending:
+                content = self._next_batch()
+                try:
+                    await channel.send(content)
+                    self.batches += 1
+                except discord.HTTPException as e:
+                    logging.error(f"Ошибка записи в лог-канал {self.channel_id}: {e}")
+
+bot_log = ChannelLogWriter(LOG_ALL_CHANNEL_ID)  # ответы бота и нажатия кнопок
+fine_log = ChannelLogWriter(LOG_CHANNEL_ID)  # штрафы
+log_writers = [bot_log, fine_log]
 DB_NAME = "../bot.db"  # Имя файла базы данных
+db = Database(DB_NAME)  # Общее соединение с базой (WAL, выделенный поток)
 
 # Регистрируем хендлеры Telegram
 @router.message(Command('start'))
@@ -261,16 +364,9 @@ class FineModal(Modal, title="Выдать штраф"):
             ctx.guild = interaction.guild
             ctx.channel = interaction.channel
 
-            # Логируем штраф в базу
-            with sqlite3.connect(DB_NAME) as conn:
-                c = conn.cursor()
-                c.execute("INSERT INTO fines (user_id, amount, reason) VALUES (?, ?, ?)", 
-                         (str(member_obj.id), amount_value, self.reason.value))
-                fine_id = c.lastrowid
-                conn.commit()
-
-            # Синхронизируем баланс
-            sync_fines_with_balance(member_obj.id)
+            # Записываем штраф и списываем его с баланса
+            fine_id = await balance_manager.issue_fine(member_obj.id, amount_value, self.reason.value,
+                                                       nickname=member_obj.display_name, by=interaction.user.id)
 
             # Создаём embed-уведомление
             embed = discord.Embed(
@@ -301,13 +397,11 @@ class FineModal(Modal, title="Выдать штраф"):
                 status_msg = messages["fine_failed_to_dm"].format(user_mention=member_obj.mention)
 
             # Отправляем сообщение в лог-канал
-            log_channel = bot.get_channel(LOG_CHANNEL_ID)
-            if log_channel:
-                await log_channel.send(f"✅ Штраф для {member_obj.mention} отправлен в {fine_channel.mention}!")
-                await log_channel.send(status_msg)
+            fine_log.write(f"✅ Штраф для {member_obj.mention} отправлен в {fine_channel.mention}!")
+            fine_log.write(status_msg)
 
-            # Отправляем уведомление в Telegram
-            await send_notification(str(member_obj.id), embed=embed)
+            # Ставим уведомление в Telegram в очередь (в ЛС штраф уже отправлен выше)
+            await outbox.enqueue(member_obj.id, embed=embed, dedupe_key=f"fine:{fine_id}", channels=("telegram",))
 
             await interaction.response.send_message("✅ Штраф успешно выдан.", ephemeral=True)
             logging.info(f"Штраф выдан: {member_obj} | Сумма: {amount_value} | Причина: {self.reason.value} | Выдал: {interaction.user}")
@@ -405,6 +499,82 @@ class SendMessageModal(Modal, title="Отправить ЛС"):
         except Exception as e:
             await interaction.response.send_message(f"❌ Ошибка при отправке: {str(e)}", ephemeral=True)
 
+# --- Постраничный просмотр списков ---
+
+class PaginatorView(View):
+    """Постраничный просмотр списка с курсорной (keyset) подгрузкой каждой страницы.
+
+    fetch(cursor, limit) возвращает до limit элементов после курсора (None — с начала),
+    key(item) даёт курсор для следующей страницы, render(items, page) — текст страницы.
+    """
+
+    def __init__(self, fetch, key, render, page_size=10, author_id=None):
+        super().__init__(timeout=300)
+        self.fetch = fetch
+        self.key = key
+        self.render = render
+        self.page_size = page_size
+        self.author_id = author_id
+        self._starts = [None]  # курсоры начала просмотренных страниц — для кнопки «назад»
+        self._next_cursor = None
+
+    @property
+    def has_pages(self):
+        return len(self._starts) > 1 or self._next_cursor is not None
+
+    async def render_current(self):
+        """Загружает текущую страницу (на один элемент больше — чтобы знать, есть ли следующая)"""
+        items = await self.fetch(self._starts[-1], self.page_size + 1)
+        has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        self._next_cursor = self.key(items[-1]) if has_next else None
+        self.previous_page.disabled = len(self._starts) == 1
+        self.next_page.disabled = not has_next
+        if not items:
+            return None
+        return self.render(items, len(self._starts))
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if self.author_id is not None and interaction.user.id != self.author_id:
+            await interaction.response.send_message("❌ Листать список может только тот, кто его открыл.", ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: Button):
+        if len(self._starts) > 1:
+            self._starts.pop()
+        content = await self.render_current()
+        await interaction.response.edit_message(content=content or "Список пуст.", view=self)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: Button):
+        if self._next_cursor is not None:
+            self._starts.append(self._next_cursor)
+        content = await self.render_current()
+        await interaction.response.edit_message(content=content or "Список пуст.", view=self)
+
+
+def balance_top_paginator(guild, author_id=None):
+    """Топ баланса по страницам из рейтинга в памяти; курсор — позиция в рейтинге"""
+    async def fetch(cursor, limit):
+        return balance_manager.leaderboard.page(cursor or 0, limit)
+
+    def render(items, page):
+        def build():
+            lines = [f"🏆 **Топ-{balance_manager.leaderboard.tracked} участников по балансу** (стр. {page}):\n\n"]
+            for rank, user_id, balance, nickname in items:
+                user = guild.get_member(int(user_id))
+                if user:
+                    lines.append(f"{rank}. {user.mention}: {balance:,} серебра\n")
+                else:
+                    lines.append(f"{rank}. {nickname or user_id}: {balance:,} серебра\n")
+            return "".join(lines)
+        return balance_manager.leaderboard.render(("panel", guild.id, items[0][0], len(items)), build)
+
+    return PaginatorView(fetch, key=lambda item: item[0], render=render, page_size=20, author_id=author_id)
+
+
 # --- Панель управления (UI-кнопки) ---
 
 class BalanceView(View):
@@ -413,29 +583,24 @@ class BalanceView(View):
 
     async def log_button_action(self, interaction, message):
         """Функция для логирования действий кнопок"""
-        log_channel = bot.get_channel(LOG_ALL_CHANNEL_ID)
-        if log_channel:
-            await log_channel.send(f"📌 **Кнопка нажата:** {message}")
+        bot_log.write(f"📌 **Кнопка нажата:** {message}")
 
     @discord.ui.button(label="💰 Мой баланс", style=discord.ButtonStyle.primary)
     async def my_balance_button(self, interaction: discord.Interaction, button: Button):
         user = interaction.user
-        current_balance = balance_manager.get_balance(user.id)
+        current_balance = await balance_manager.get_balance(user.id)
         response = f"💰 {user.mention}, ваш баланс: {current_balance} серебра."
         await interaction.response.send_message(response, ephemeral=True)
         await self.log_button_action(interaction, response)
 
     @discord.ui.button(label="🏆 Топ баланса", style=discord.ButtonStyle.secondary)
     async def balance_top_button(self, interaction: discord.Interaction, button: Button):
-        top_balances = balance_manager.top_balances(top_n=100)
-        response = "🏆 **Топ-100 участников по балансу:**\n\n"
-        for i, (user_id, balance, nickname) in enumerate(top_balances, 1):
-            user = interaction.guild.get_member(int(user_id))
-            if user:
-                response += f"{i}. {user.mention}: {balance:,} серебра\n"
-            else:
-                response += f"{i}. {nickname or user_id}: {balance:,} серебра\n"
-        await interaction.response.send_message(response, ephemeral=True)
+        view = balance_top_paginator(interaction.guild)
+        response = await view.render_current() or "🏆 Топ баланса пуст."
+        if view.has_pages:
+            await interaction.response.send_message(response, view=view, ephemeral=True)
+        else:
+            await interaction.response.send_message(response, ephemeral=True)
         await self.log_button_action(interaction, "Запрошен топ баланса")
 
     @discord.ui.button(label="🔄 Перевести", style=discord.ButtonStyle.success)
@@ -501,14 +666,12 @@ class CommandControlPanel(View):
 
     async def log_button_action(self, interaction, message):
         """Функция для логирования действий кнопок"""
-        log_channel = bot.get_channel(LOG_ALL_CHANNEL_ID)
-        if log_channel:
-            await log_channel.send(f"📌 **Кнопка нажата:** {message}")
+        bot_log.write(f"📌 **Кнопка нажата:** {message}")
 
     @discord.ui.button(label="💰 Баланс", style=discord.ButtonStyle.primary)
     async def balance_button(self, interaction: discord.Interaction, button: Button):
         user = interaction.user
-        current_balance = balance_manager.get_balance(user.id)
+        current_balance = await balance_manager.get_balance(user.id)
         response = f"💰 {user.mention}, ваш баланс: {current_balance} серебра."
         await interaction.response.send_message(response, ephemeral=True)
         await self.log_button_action(interaction, response)
@@ -578,77 +741,12 @@ def load_config_file():
 def save_config_file(new_config):
     with open(config_file_path, "w") as config_file:
         json.dump(new_config, config_file, indent=4)
+    routing.load(new_config)  # Индекс пересылки пересобирается сразу, не дожидаясь проверки mtime
 
-# Инициализация базы данных с использованием контекстного менеджера
+# Инициализация базы данных: миграции схемы до актуальной версии (до запуска event loop)
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
-        c = conn.cursor()
-        # Таблица баланса
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS balances (
-                member_id TEXT PRIMARY KEY,
-                balance INTEGER NOT NULL DEFAULT 0,
-                nickname TEXT
-            )
-        """)
-        # Таблица транзакций
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                type TEXT NOT NULL,
-                member_id TEXT NOT NULL,
-                amount INTEGER NOT NULL,
-                note TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Таблица штрафов
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS fines (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                amount INTEGER NOT NULL,
-                reason TEXT,
-                is_closed INTEGER DEFAULT 0
-            )
-        """)
-        # Таблица сборов
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS parties (
-                party_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                creator_id TEXT NOT NULL,
-                info TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Таблица участников сборов
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS party_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                party_id INTEGER NOT NULL,
-                member_id TEXT NOT NULL,
-                FOREIGN KEY(party_id) REFERENCES parties(party_id) ON DELETE CASCADE
-            )
-        """)
-        # Таблица для хранения связей Discord-Telegram
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS telegram_links (
-                discord_id TEXT PRIMARY KEY,
-                telegram_id TEXT NOT NULL,
-                telegram_username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Таблица для временных кодов привязки
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS telegram_link_codes (
-                code TEXT PRIMARY KEY,
-                discord_id TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
+    for version, description in db.run_blocking(migrate):
+        logging.info(f"Применена миграция схемы {version}: {description}")
 
 init_db()  # Инициализация базы данных при запуске
 
@@ -657,17 +755,144 @@ async def has_role(member, role_id):
     role = discord.utils.get(member.guild.roles, id=role_id)
     return role in member.roles if role else False
 
+# ==============================
+# Индекс участников гильдии по именам (для поиска по нику без перебора guild.members)
+# ==============================
+class MemberNameIndex:
+    """Индекс участников одной гильдии: точное имя, префикс (bisect) и подстрока (триграммы)"""
+
+    def __init__(self, members=()):
+        self._names = {}  # member_id -> frozenset(имён в нижнем регистре)
+        self._exact = {}  # имя -> set(member_id)
+        self._sorted = []  # отсортированные (имя, member_id) для поиска по префиксу
+        self._trigrams = {}  # триграмма -> set(member_id)
+        for member in members:
+            self.add(member)
+
+    @staticmethod
+    def names_of(member):
+        names = (member.name, member.nick, getattr(member, "global_name", None))
+        return frozenset(name.lower() for name in names if name)
+
+    @staticmethod
+    def _trigrams_of(name):
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    def add(self, member):
+        """Добавляет участника или обновляет его имена"""
+        if member.id in self._names:
+            self.remove(member.id)
+        names = self.names_of(member)
+        self._names[member.id] = names
+        for name in names:
+            self._exact.setdefault(name, set()).add(member.id)
+            insort(self._sorted, (name, member.id))
+            for trigram in self._trigrams_of(name):
+                self._trigrams.setdefault(trigram, set()).add(member.id)
+
+    def remove(self, member_id):
+        names = self._names.pop(member_id, None)
+        if not names:
+            return
+        for name in names:
+            ids = self._exact[name]
+            ids.discard(member_id)
+            if not ids:
+                del self._exact[name]
+            del self._sorted[bisect_left(self._sorted, (name, member_id))]
+            for trigram in self._trigrams_of(name):
+                ids = self._trigrams.get(trigram)
+                if ids is not None:
+                    ids.discard(member_id)
+                    if not ids:
+                        del self._trigrams[trigram]
+
+    def _prefix(self, prefix):
+        ids = set()
+        i = bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted) and self._sorted[i][0].startswith(prefix):
+            ids.add(self._sorted[i][1])
+            i += 1
+        return ids
+
+    def _substring(self, query):
+        if len(query) < 3:
+            candidates = self._names.keys()  # слишком короткий запрос для триграмм
+        else:
+            sets = sorted((self._trigrams.get(t, set()) for t in self._trigrams_of(query)), key=len)
+            candidates = sets[0].intersection(*sets[1:])
+        return {member_id for member_id in candidates if any(query in name for name in self._names[member_id])}
+
+    def lookup(self, query):
+        """Возвращает (вид совпадения, отсортированные member_id): exact, prefix, substring или none"""
+        query = query.strip().lstrip("@").lower()
+        if not query:
+            return "none", []
+        for kind, find in (("exact", lambda q: self._exact.get(q, set())),
+                           ("prefix", self._prefix),
+                           ("substring", self._substring)):
+            ids = find(query)
+            if ids:
+                return kind, sorted(ids)
+        return "none", []
+
+    def search(self, query):
+        """Все участники, в имени которых встречается query"""
+        query = query.strip().lstrip("@").lower()
+        return sorted(self._substring(query)) if query else []
+
+member_indexes = {}  # guild_id -> MemberNameIndex
+
+def member_index(guild):
+    index = member_indexes.get(guild.id)
+    if index is None:
+        index = member_indexes[guild.id] = MemberNameIndex(guild.members)
+    return index
+
+def resolve_member(guild, text):
+    """Ищет участника по упоминанию, ID или имени.
+
+    Возвращает (участник или None, кандидаты): при неоднозначном имени участник None,
+    а в кандидатах — все подходящие участники наиболее точного вида совпадения.
+    """
+    text = text.strip()
+    mention_match = re.match(r"<@!?(\d+)>$", text)
+    if mention_match or text.isdigit():
+        member = guild.get_member(int(mention_match.group(1) if mention_match else text))
+        if member:
+            return member, [member]
+    _, ids = member_index(guild).lookup(text)
+    candidates = [member for member in map(guild.get_member, ids) if member]
+    return (candidates[0] if len(candidates) == 1 else None), candidates
+
 @bot.event
 async def on_ready():
+    for guild in bot.guilds:
+        member_indexes[guild.id] = MemberNameIndex(guild.members)
+    routing.rebuild_members()
     logging.info(f"Бот {bot.user} запущен!")
     print(f"Бот {bot.user} запущен!")
     print("Зарегистрированные команды:", [cmd.name for cmd in bot.commands])
 
+@bot.before_invoke
+async def start_command_log(ctx):
+    # Контекст виден всем записям лога, сделанным внутри команды
+    ctx.started_at = time.monotonic()
+    log_context.set({
+        "command": ctx.command.qualified_name,
+        "user": str(ctx.author.id),
+        "guild": str(ctx.guild.id) if ctx.guild else None,
+    })
+
+@bot.after_invoke
+async def finish_command_log(ctx):
+    latency_ms = round((time.monotonic() - ctx.started_at) * 1000, 1)
+    status = "завершилась ошибкой" if ctx.command_failed else "выполнена"
+    logging.info(f"Команда !{ctx.command.qualified_name} {status}", extra={"latency_ms": latency_ms})
+
 async def log_bot_response(ctx, message):
     """Отправляет сообщение в лог-канал"""
-    log_channel = bot.get_channel(LOG_ALL_CHANNEL_ID)
-    if log_channel:
-        await log_channel.send(f"📝 **Ответ бота:** {message}")
+    bot_log.write(f"📝 **Ответ бота:** {message}")
 
 
 # ==============================
@@ -745,7 +970,259 @@ async def list_channel_roles(ctx):
 # ==============================
 # Функционал пересылки сообщений из назначенных каналов в ЛС
 # ==============================
+class RoleChannelRouting:
+    """Инвертированный индекс пересылки: канал -> роли -> участники.
+
+    Строится из role_channel_map в config.json и пересобирается только при изменении файла
+    (save_config_file или новая mtime), поэтому on_message не читает диск.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self.channel_roles = {}  # channel_id -> frozenset(role_id)
+        self.role_members = {}  # role_id -> set(member_id), только для ролей из мапы
+
+    def load(self, cfg=None):
+        if cfg is None:
+            cfg = load_config_file()
+        channel_roles = {}
+        for role_id, channel_ids in cfg.get("role_channel_map", {}).items():
+            for channel_id in channel_ids:
+                channel_roles.setdefault(int(channel_id), set()).add(int(role_id))
+        self.channel_roles = {channel_id: frozenset(role_ids) for channel_id, role_ids in channel_roles.items()}
+        self._mtime = os.path.getmtime(self.path)
+        self.rebuild_members()
+
+    def refresh_if_changed(self):
+        """Пересобирает индекс, если config.json изменили извне (например, из web-app)"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self.load()
+        logging.info("Индекс пересылки пересобран после изменения config.json")
+        return True
+
+    def rebuild_members(self):
+        role_members = {role_id: set() for role_ids in self.channel_roles.values() for role_id in role_ids}
+        for guild in bot.guilds:
+            for member in guild.members:
+                if member.bot:
+                    continue
+                for role in member.roles:
+                    if role.id in role_members:
+                        role_members[role.id].add(member.id)
+        self.role_members = role_members
+
+    def update_member(self, member):
+        role_ids = {role.id for role in member.roles}
+        for role_id, member_ids in self.role_members.items():
+            if role_id in role_ids and not member.bot:
+                member_ids.add(member.id)
+            else:
+                member_ids.discard(member.id)
+
+    def remove_member(self, member):
+        for member_ids in self.role_members.values():
+            member_ids.discard(member.id)
+
+    def recipients(self, channel_id):
+        """ID участников, которым пересылается сообщение из канала (пусто, если канал не в мапе)"""
+        role_ids = self.channel_roles.get(channel_id)
+        if not role_ids:
+            return set()
+        return set().union(*(self.role_members.get(role_id, ()) for role_id in role_ids))
+
+routing = RoleChannelRouting(config_file_path)
+routing.load()
+
+async def watch_config_changes(interval=5):
+    """Раз в interval секунд сверяет mtime config.json с индексом пересылки"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            routing.refresh_if_changed()
+        except Exception as e:
+            logging.error(f"Ошибка обновления индекса пересылки: {e}")
+
+class DeliveryReport:
+    """Статистика доставки одной рассылки"""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.delivered = 0
+        self.forbidden = 0  # ЛС закрыты
+        self.failed = 0
+        self.retries = 0
+        self.telegram_delivered = 0
+        self.telegram_failed = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._finished = asyncio.Event()
+        if total == 0:
+            self._finish()
+
+    @property
+    def done(self):
+        return self.delivered + self.forbidden + self.failed
+
+    def record(self, outcome, telegram_outcome=None):
+        """Учитывает исход для одного получателя: Discord (обязательно) и Telegram (если привязан)"""
+        if telegram_outcome:
+            setattr(self, f"telegram_{telegram_outcome}", getattr(self, f"telegram_{telegram_outcome}") + 1)
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        if self.done >= self.total:
+            self._finish()
+
+    def _finish(self):
+        self.finished_at = time.monotonic()
+        self._finished.set()
+
+    async def wait(self):
+        await self._finished.wait()
+        return self
+
+    def summary(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        telegram = ""
+        if self.telegram_delivered or self.telegram_failed:
+            telegram = f", Telegram {self.telegram_delivered} (ошибки {self.telegram_failed})"
+        return (f"{self.label}: доставлено {self.delivered}/{self.total}, ЛС закрыты {self.forbidden}{telegram}, "
+                f"ошибки {self.failed}, повторы {self.retries}, {elapsed:.1f} с")
+
+
+class DMDispatcher:
+    """Фоновая рассылка ЛС: очередь, ограниченное число воркеров и общий token bucket.
+
+    На 429 вся рассылка ждёт retry-after от Discord и повторяет отправку.
+    """
+
+    def __init__(self, workers, rate, burst, max_retries=3):
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue()
+        self.recent = deque(maxlen=20)  # последние рассылки для !dm_stats
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, members, label, **send_kwargs):
+        """Ставит ЛС участникам в очередь и сразу возвращает отчёт о доставке"""
+        report = DeliveryReport(label, len(members))
+        self.recent.append(report)
+        for member in members:
+            self.queue.put_nowait((report, member, send_kwargs))
+        return report
+
+    async def _worker(self):
+        while True:
+            report, member, send_kwargs = await self.queue.get()
+            try:
+                report.record(await self.send(member, report, **send_kwargs))
+            except Exception as e:
+                report.record("failed")
+                logging.error(f"Ошибка рассылки ЛС пользователю {member}: {e}")
+            finally:
+                self.queue.task_done()
+            if report.finished_at is not None and report.done == report.total:
+                logging.info(f"Рассылка завершена — {report.summary()}")
+
+    async def send(self, member, report=None, **send_kwargs):
+        """Отправляет одно ЛС в пределах лимита с повторами на 429: delivered, forbidden или failed"""
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await member.send(**send_kwargs)
+                return "delivered"
+            except discord.Forbidden:
+                logging.warning(f"Не удалось отправить DM пользователю {member.name}")
+                return "forbidden"
+            except discord.RateLimited as e:
+                retry_after = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    logging.error(f"Ошибка отправки DM пользователю {member.name}: {e}")
+                    return "failed"
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+            if report is not None:
+                report.retries += 1
+            self.bucket.pause(retry_after)
+        logging.error(f"DM пользователю {member.name} не доставлено: превышено число повторов")
+        return "failed"
+
+# Лимиты ЛС Discord задаются только здесь (значения по умолчанию можно переопределить в config.json)
+dm_dispatcher = DMDispatcher(
+    workers=config.get("DM_WORKERS", 3),
+    rate=config.get("DM_RATE_PER_SECOND", 5.0),
+    burst=config.get("DM_BURST", 10),
+)
+
+@bot.command(name="dm_stats")
+async def dm_stats(ctx):
+    """Показывает статистику последних рассылок ЛС"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ У вас нет прав для использования этой команды.")
+        return
+    links = telegram_links.stats()
+    lines = [f"📬 В очереди ЛС: {dm_dispatcher.queue.qsize()} | 📮 Уведомлений ожидает: {await outbox.pending_count()} "
+             f"(доставлено {outbox.delivered}, не доставлено {outbox.failed})",
+             f"🔗 Связей с Telegram: {links['size']} | Попадания: {links['hits']} | Промахи: {links['misses']} "
+             f"| Hit rate: {links['hit_rate']}%"]
+    telegram = telegram_sender.stats()
+    lines.append(f"✈️ Telegram: в очереди {telegram['queued']}, доставлено {telegram['delivered']}, "
+                 f"заблокировали бота {telegram['forbidden']}, ошибки {telegram['failed']}, "
+                 f"повторы {telegram['retries']}, {telegram['per_second']} сообщ./с за минуту")
+    reports = [("✅ " if report.finished_at else "⏳ ") + report.summary() for report in reversed(dm_dispatcher.recent)]
+    if not reports:
+        lines.append("ℹ️ Рассылок ЛС ещё не было.")
+    # Сообщение Discord — не больше 2000 символов: самые старые рассылки не показываем
+    size = len("\n".join(lines))
+    for shown, line in enumerate(reports):
+        if size + len(line) + 1 > 2000 - 30:  # место под строку «… и ещё N рассылок»
+            lines.append(f"… и ещё {len(reports) - shown} рассылок")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    await ctx.send("\n".join(lines))
+
+@bot.event
+async def on_member_join(member):
+    routing.update_member(member)
+    member_index(member.guild).add(member)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        routing.update_member(after)
+    if MemberNameIndex.names_of(before) != MemberNameIndex.names_of(after):
+        member_index(after.guild).add(after)
+
+@bot.event
+async def on_user_update(before, after):
+    # Смена username/global_name приходит на уровне пользователя, а не участника
+    for guild in after.mutual_guilds:
+        member = guild.get_member(after.id)
+        if member:
+            member_index(guild).add(member)
+
 @bot.event
+async def on_member_remove(member):
+    routing.remove_member(member)
+    member_index(member.guild).remove(member.id)
+
 @bot.event
 async def on_message(message):
     # Игнорируем сообщения от ботов
@@ -773,33 +1250,18 @@ async def on_message(message):
             await log_channel.send(embed=embed)
 
     # ✅ 2. Обычная логика пересылки сообщений с каналов в ЛС, которую ты уже сделал (из role_channel_map)
-    cfg = load_config_file()
-    role_channel_map = cfg.get("role_channel_map", {})
-    sent_members = set()
+    recipient_ids = routing.recipients(message.channel.id) if message.guild else set()
+    members = [member for member in map(message.guild.get_member, recipient_ids) if member] if recipient_ids else []
 
-    for role_id_str, channel_ids in role_channel_map.items():
-        if str(message.channel.id) in channel_ids:
-            role_obj = message.guild.get_role(int(role_id_str))
-            if not role_obj:
-                continue
-            for member in message.guild.members:
-                if member.bot:
-                    continue
-                if role_obj in member.roles and member.id not in sent_members:
-                    try:
-                        embed = discord.Embed(
-                            title=f"Новое сообщение из #{message.channel.name}",
-                            description=message.content or "*Нет текста*",
-                            color=discord.Color.blue()
-                        )
-                        embed.set_footer(text=f"Автор: {message.author.display_name}")
-                        await member.send(embed=embed)
-                        sent_members.add(member.id)
-                        await asyncio.sleep(1)
-                    except discord.Forbidden:
-                        logging.warning(f"Не удалось отправить DM пользователю {member.name}")
-                    except Exception as e:
-                        logging.error(f"Ошибка отправки DM пользователю {member.name}: {e}")
+    if members:
+        # Рассылка уходит в фоновую очередь — обработка команд её не ждёт
+        embed = discord.Embed(
+            title=f"Новое сообщение из #{message.channel.name}",
+            description=message.content or "*Нет текста*",
+            color=discord.Color.blue()
+        )
+        embed.set_footer(text=f"Автор: {message.author.display_name}")
+        dm_dispatcher.submit(members, f"Пересылка из #{message.channel.name}", embed=embed)
 
     # ✅ Запускаем обработку команд
     await bot.process_commands(message)
@@ -807,88 +1269,341 @@ async def on_message(message):
 # ==============================
 # Класс для управления балансом пользователей
 # ==============================
+class BalanceCache:
+    """Ограниченный LRU-кэш балансов (member_id -> баланс), обновляется при каждой записи"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, member_id):
+        key = str(member_id)
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, member_id, balance):
+        key = str(member_id)
+        self._data[key] = balance
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = round(self.hits * 100 / total, 1) if total else 0.0
+        return {"size": len(self._data), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+
+class BalanceLeaderboard:
+    """Отсортированный в памяти рейтинг балансов, обновляется точечно при каждом изменении.
+
+    Кэш отрисованного топа сбрасывается только если изменение затронуло первые tracked мест.
+    """
+
+    def __init__(self, tracked=100):
+        self.tracked = tracked
+        self._keys = []  # отсортированный список (-balance, member_id)
+        self._entries = {}  # member_id -> (balance, nickname)
+        self._rendered = {}
+        self.version = 0
+
+    def load(self, rows):
+        self._entries = {str(member_id): (balance, nickname) for member_id, balance, nickname in rows}
+        self._keys = sorted((-balance, member_id) for member_id, (balance, _) in self._entries.items())
+        self._invalidate()
+
+    def _invalidate(self):
+        self.version += 1
+        self._rendered.clear()
+
+    def update(self, member_id, balance, nickname=None):
+        """Переставляет участника на новое место; nickname=None сохраняет прежний ник"""
+        member_id = str(member_id)
+        old = self._entries.get(member_id)
+        if not nickname:
+            nickname = old[1] if old else nickname
+        if old == (balance, nickname):
+            return
+        changed = False
+        if old is not None:
+            old_rank = bisect_left(self._keys, (-old[0], member_id))
+            del self._keys[old_rank]
+            changed = old_rank < self.tracked
+        new_key = (-balance, member_id)
+        new_rank = bisect_left(self._keys, new_key)
+        self._keys.insert(new_rank, new_key)
+        self._entries[member_id] = (balance, nickname)
+        if changed or new_rank < self.tracked:
+            self._invalidate()
+
+    def top(self, top_n=100):
+        return [(member_id, -neg_balance, self._entries[member_id][1])
+                for neg_balance, member_id in self._keys[:top_n]]
+
+    def page(self, offset, limit):
+        """Срез рейтинга в пределах tracked мест: [(место, member_id, баланс, ник)]"""
+        end = min(offset + limit, self.tracked)
+        return [(rank, member_id, -neg_balance, self._entries[member_id][1])
+                for rank, (neg_balance, member_id) in enumerate(self._keys[offset:end], offset + 1)]
+
+    def render(self, key, build):
+        """Возвращает закэшированный текст топа или строит его через build()"""
+        if key not in self._rendered:
+            self._rendered[key] = build()
+        return self._rendered[key]
+
+
 class BalanceManager:
-    def __init__(self, db_name=DB_NAME):
-        self.db_name = db_name
-
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        return conn
-
-    def get_balance(self, member_id):
-        with self.get_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT balance FROM balances WHERE member_id = ?", (str(member_id),))
-            row = c.fetchone()
-            return row["balance"] if row else 0
-
-    def deposit(self, member_id, amount, nickname="", by=None, note=""):
+    def __init__(self, database=db):
+        self.db = database
+        self.cache = BalanceCache()
+        self.leaderboard = BalanceLeaderboard()
+
+    def load_leaderboard(self):
+        """Однократно загружает рейтинг из базы (до запуска event loop)"""
+        rows = self.db.run_blocking(lambda conn: conn.execute("SELECT member_id, balance, nickname FROM balances").fetchall())
+        self.leaderboard.load([tuple(row) for row in rows])
+
+    def _publish(self, entries, new_balances):
+        # Новые балансы попадают в кэш и рейтинг после успешной транзакции
+        nicknames = {str(member_id): nickname for member_id, _, nickname, _, _ in entries}
+        for member_id, balance in new_balances.items():
+            self.cache.put(member_id, balance)
+            self.leaderboard.update(member_id, balance, nicknames.get(member_id))
+
+    @staticmethod
+    def _get_balance(conn, member_id):
+        row = conn.execute("SELECT balance FROM balances WHERE member_id = ?", (str(member_id),)).fetchone()
+        return row["balance"] if row else 0
+
+    async def get_balance(self, member_id):
+        cached = self.cache.get(member_id)
+        if cached is not None:
+            return cached
+        current = await self.db.run(self._get_balance, member_id)
+        self.cache.put(member_id, current)
+        return current
+
+    @staticmethod
+    def _apply(conn, entries):
+        """Применяет изменения балансов и пишет записи в журнал в текущей транзакции.
+
+        entries — список (member_id, delta, nickname, type, note). Возвращает новые балансы.
+        """
+        # Баланс меняется на месте, без чтения в Python — параллельные команды не теряют обновлений
+        conn.executemany("""
+            INSERT INTO balances (member_id, balance, nickname) VALUES (?, ?, ?)
+            ON CONFLICT(member_id) DO UPDATE SET
+                balance = balance + excluded.balance,
+                nickname = COALESCE(NULLIF(excluded.nickname, ''), nickname)
+        """, [(str(member_id), delta, nickname) for member_id, delta, nickname, _, _ in entries])
+        conn.executemany("INSERT INTO transactions (type, member_id, amount, note) VALUES (?, ?, ?, ?)",
+                         [(tx_type, str(member_id), delta, note) for member_id, delta, _, tx_type, note in entries])
+        member_ids = list({str(member_id) for member_id, *_ in entries})
+        rows = conn.execute(f"SELECT member_id, balance FROM balances WHERE member_id IN ({','.join('?' * len(member_ids))})",
+                            member_ids).fetchall()
+        return {row["member_id"]: row["balance"] for row in rows}
+
+    async def deposit(self, member_id, amount, nickname="", by=None, note=""):
         if amount < 0:
             raise ValueError("Сумма должна быть положительной")
-        with self.get_connection() as conn:
-            c = conn.cursor()
-            current = self.get_balance(member_id)
-            new_balance = current + amount
-            c.execute("INSERT OR REPLACE INTO balances (member_id, balance, nickname) VALUES (?, ?, ?)",
-                      (str(member_id), new_balance, nickname))
-            c.execute("INSERT INTO transactions (type, member_id, amount, note) VALUES (?, ?, ?, ?)",
-                      ("DEPOSIT", str(member_id), amount, f"by {by}: {note}"))
-            conn.commit()
-
-    def withdraw(self, member_id, amount, nickname="", by=None, note=""):
+        entries = [(member_id, amount, nickname, "DEPOSIT", f"by {by}: {note}")]
+        new_balances = await self.db.run(self._apply, entries)
+        self._publish(entries, new_balances)
+        return new_balances[str(member_id)]
+
+    async def withdraw(self, member_id, amount, nickname="", by=None, note=""):
         if amount < 0:
             raise ValueError("Сумма должна быть положительной")
-        current = self.get_balance(member_id)
-        new_balance = current - amount  # не проверяем на отрицательный результат
-        with self.get_connection() as conn:
-            c = conn.cursor()
-            c.execute("UPDATE balances SET balance = ?, nickname = ? WHERE member_id = ?",
-                    (new_balance, nickname, str(member_id)))
-            c.execute("INSERT INTO transactions (type, member_id, amount, note) VALUES (?, ?, ?, ?)",
-                    ("WITHDRAW", str(member_id), -amount, f"by {by}: {note}"))
-            conn.commit()
-
-
-    def transfer(self, from_member, to_member, amount, from_nickname="", to_nickname="", note=""):
+        # не проверяем на отрицательный результат
+        entries = [(member_id, -amount, nickname, "WITHDRAW", f"by {by}: {note}")]
+        new_balances = await self.db.run(self._apply, entries)
+        self._publish(entries, new_balances)
+        return new_balances[str(member_id)]
+
+    async def transfer(self, from_member, to_member, amount, from_nickname="", to_nickname="", note=""):
         if amount < 0:
             raise ValueError("Сумма должна быть положительной")
     # убираем проверку остатка:
     # if self.get_balance(from_member) < amount:
     #     raise ValueError("Недостаточно средств для перевода")
-        self.withdraw(from_member, amount, nickname=from_nickname, by=from_member, note=f"Transfer to {to_member}. {note}")
-        self.deposit(to_member, amount, nickname=to_nickname, by=from_member, note=f"Transfer from {from_member}. {note}")
-
-
-
-    def top_balances(self, top_n=100):
-        with self.get_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT member_id, balance, nickname FROM balances ORDER BY balance DESC LIMIT ?", (top_n,))
-            rows = c.fetchall()
-            return [(row["member_id"], row["balance"], row["nickname"]) for row in rows]
+        # Списание и зачисление — одна транзакция: либо обе записи, либо ни одной
+        entries = [
+            (from_member, -amount, from_nickname, "WITHDRAW", f"by {from_member}: Transfer to {to_member}. {note}"),
+            (to_member, amount, to_nickname, "DEPOSIT", f"by {from_member}: Transfer from {from_member}. {note}"),
+        ]
+        new_balances = await self.db.run(self._apply, entries)
+        self._publish(entries, new_balances)
+        return new_balances
+
+    async def issue_fine(self, member_id, amount, reason, nickname="", by=None):
+        """Записывает штраф и списывает его сумму с баланса в одной транзакции; возвращает номер штрафа"""
+        if amount < 0:
+            raise ValueError("Сумма должна быть положительной")
 
-    def get_history(self, member_id):
-        with self.get_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT type, amount, note, timestamp FROM transactions WHERE member_id = ? ORDER BY timestamp DESC LIMIT 10", (str(member_id),))
-            rows = c.fetchall()
-            return [(row["type"], row["amount"], row["note"], row["timestamp"]) for row in rows]
+        def _issue(conn):
+            fine_id = conn.execute("INSERT INTO fines (user_id, amount, reason, debited) VALUES (?, ?, ?, 1)",
+                                   (str(member_id), amount, reason)).lastrowid
+            entries = [(member_id, -amount, nickname, "FINE", f"by {by}: Штраф #{fine_id}: {reason}")]
+            new_balances = self._apply(conn, entries)
+            conn.execute("UPDATE balances SET open_fines = open_fines + ? WHERE member_id = ?", (amount, str(member_id)))
+            return fine_id, entries, new_balances
+
+        fine_id, entries, new_balances = await self.db.run(_issue)
+        self._publish(entries, new_balances)
+        return fine_id
+
+    async def close_fine(self, fine_id, by=None):
+        """Закрывает штраф и возвращает его сумму на баланс в одной транзакции.
+
+        Сумма возвращается, только если она была списана (debited) — штрафы, внесённые мимо бота, баланс не меняют.
+        Возвращает (user_id, закрыт ли сейчас) или None, если штрафа нет.
+        """
+        def _close(conn):
+            row = conn.execute("SELECT user_id, amount, debited FROM fines WHERE id = ?", (fine_id,)).fetchone()
+            if row is None:
+                return None
+            # Условие is_closed = 0 не даёт вернуть сумму дважды при повторном закрытии
+            if not conn.execute("UPDATE fines SET is_closed = 1 WHERE id = ? AND is_closed = 0", (fine_id,)).rowcount:
+                return row["user_id"], False, [], {}
+            entries, new_balances = [], {}
+            if row["debited"]:
+                entries = [(row["user_id"], row["amount"], "", "FINE_CLOSED", f"by {by}: Закрыт штраф #{fine_id}")]
+                new_balances = self._apply(conn, entries)
+            conn.execute("UPDATE balances SET open_fines = open_fines - ? WHERE member_id = ?", (row["amount"], row["user_id"]))
+            return row["user_id"], True, entries, new_balances
+
+        result = await self.db.run(_close)
+        if result is None:
+            return None
+        user_id, closed, entries, new_balances = result
+        self._publish(entries, new_balances)
+        return user_id, closed
+
+    async def get_open_fines(self, member_id):
+        """Сумма открытых штрафов участника (хранится в balances.open_fines)"""
+        row = await self.db.fetchone("SELECT open_fines FROM balances WHERE member_id = ?", (str(member_id),))
+        return row["open_fines"] if row else 0
+
+    @staticmethod
+    def _get_balances(conn, member_ids):
+        balances = {}
+        member_ids = [str(member_id) for member_id in member_ids]
+        for i in range(0, len(member_ids), 500):  # не упираемся в лимит параметров SQLite
+            chunk = member_ids[i:i + 500]
+            rows = conn.execute(f"SELECT member_id, balance FROM balances WHERE member_id IN ({','.join('?' * len(chunk))})", chunk)
+            balances.update((row["member_id"], row["balance"]) for row in rows)
+        return balances
+
+    async def get_balances(self, member_ids):
+        """Балансы нескольких участников одним запросом (нет записи — 0)"""
+        found = await self.db.run(self._get_balances, member_ids)
+        return {str(member_id): found.get(str(member_id), 0) for member_id in member_ids}
+
+    async def set_balances(self, targets, by=None, note=""):
+        """Устанавливает балансы списком в одной транзакции.
+
+        targets — список (member_id, новый баланс, nickname). Возвращает [(member_id, было, стало)]
+        только для изменившихся балансов; на каждое изменение пишется одна запись в журнал.
+        """
+        def _set(conn):
+            old = self._get_balances(conn, [member_id for member_id, _, _ in targets])
+            changes = [(str(member_id), old.get(str(member_id), 0), new, nickname)
+                       for member_id, new, nickname in targets if old.get(str(member_id), 0) != new]
+            conn.executemany("""
+                INSERT INTO balances (member_id, balance, nickname) VALUES (?, ?, ?)
+                ON CONFLICT(member_id) DO UPDATE SET
+                    balance = excluded.balance,
+                    nickname = COALESCE(NULLIF(excluded.nickname, ''), nickname)
+            """, [(member_id, new, nickname) for member_id, _, new, nickname in changes])
+            conn.executemany("INSERT INTO transactions (type, member_id, amount, note) VALUES (?, ?, ?, ?)",
+                             [("DEPOSIT" if new > was else "WITHDRAW", member_id, new - was, f"by {by}: {note} ({was} → {new})")
+                              for member_id, was, new, _ in changes])
+            return changes
+
+        changes = await self.db.run(_set)
+        for member_id, _, new, nickname in changes:
+            self.cache.put(member_id, new)
+            self.leaderboard.update(member_id, new, nickname)
+        return [(member_id, was, new) for member_id, was, new, _ in changes]
+
+    async def reset_balances(self, member_ids=None, sign="all", by=None, note=""):
+        """Обнуляет балансы одним UPDATE и пишет журнал одним INSERT ... SELECT в одной транзакции.
+
+        member_ids ограничивает сброс списком участников (например, ролью), sign — "all",
+        "positive" или "negative". Возвращает (число участников, сумма обнулённых балансов).
+        """
+        condition = {"all": "balance != 0", "positive": "balance > 0", "negative": "balance < 0"}[sign]
+        if member_ids is not None:
+            condition += " AND member_id IN (SELECT member_id FROM temp.reset_scope)"
+
+        def _reset(conn):
+            if member_ids is not None:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS reset_scope (member_id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM temp.reset_scope")
+                conn.executemany("INSERT OR IGNORE INTO temp.reset_scope (member_id) VALUES (?)",
+                                 [(str(member_id),) for member_id in member_ids])
+            reset_ids = [row[0] for row in conn.execute(f"SELECT member_id FROM balances WHERE {condition}")]
+            total = conn.execute(f"SELECT COALESCE(SUM(balance), 0) FROM balances WHERE {condition}").fetchone()[0]
+            conn.execute(f"""
+                INSERT INTO transactions (type, member_id, amount, note)
+                SELECT 'WITHDRAW', member_id, -balance, ? FROM balances WHERE {condition}
+            """, (f"by {by}: {note}",))
+            conn.execute(f"UPDATE balances SET balance = 0 WHERE {condition}")
+            return reset_ids, total
+
+        reset_ids, total = await self.db.run(_reset)
+        for member_id in reset_ids:
+            self.cache.put(member_id, 0)
+            self.leaderboard.update(member_id, 0)
+        return len(reset_ids), total
+
+    async def top_balances(self, top_n=100):
+        return self.leaderboard.top(top_n)
+
+    async def get_history(self, member_id, cursor=None, limit=10):
+        """Страница истории, начиная после курсора (timestamp, id); без OFFSET и полной выборки"""
+        if cursor is None:
+            rows = await self.db.fetchall("""
+                SELECT id, type, amount, note, timestamp FROM transactions
+                WHERE member_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+            """, (str(member_id), limit))
+        else:
+            rows = await self.db.fetchall("""
+                SELECT id, type, amount, note, timestamp FROM transactions
+                WHERE member_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?
+            """, (str(member_id), cursor[0], cursor[1], limit))
+        return [(row["id"], row["type"], row["amount"], row["note"], row["timestamp"]) for row in rows]
 
 balance_manager = BalanceManager()
+balance_manager.load_leaderboard()
 
 # ==============================
 # Команды для управления балансом (balance)
 # ==============================
 @bot.group(invoke_without_command=True)
 async def balance(ctx):
-    current_balance = balance_manager.get_balance(ctx.author.id)
-    await ctx.send(messages["balance_show"].format(user_mention=ctx.author.mention, balance=current_balance))
+    current_balance = await balance_manager.get_balance(ctx.author.id)
+    text = messages["balance_show"].format(user_mention=ctx.author.mention, balance=current_balance)
+    open_fines = await balance_manager.get_open_fines(ctx.author.id)
+    if open_fines:
+        text += "\n" + messages["balance_open_fines"].format(open_fines=open_fines)
+    await ctx.send(text)
 
 @balance.command(name="deposit")
 async def balance_deposit(ctx, member: discord.Member, amount: int):
     try:
-        balance_manager.deposit(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Deposit command")
+        await balance_manager.deposit(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Deposit command")
         response = f"💰 Баланс {member.mention} пополнен на {amount} серебра."
         await ctx.send(response)
         await log_bot_response(ctx, response)
@@ -906,7 +1621,7 @@ async def balance_withdraw(ctx, member: discord.Member, amount: int):
         await log_bot_response(ctx, response)
         return
     try:
-        balance_manager.withdraw(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Withdraw command")
+        await balance_manager.withdraw(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Withdraw command")
         response = f"💳 Снято {amount} серебра у {member.mention}."
         await ctx.send(response)
         await log_bot_response(ctx, response)
@@ -919,7 +1634,7 @@ async def balance_withdraw(ctx, member: discord.Member, amount: int):
 @balance.command(name="transfer")
 async def balance_transfer(ctx, member: discord.Member, amount: int):
     try:
-        balance_manager.transfer(ctx.author.id, member.id, amount, 
+        await balance_manager.transfer(ctx.author.id, member.id, amount,
                                  from_nickname=ctx.author.display_name, to_nickname=member.display_name,
                                  note="Transfer command")
         response = f"🔄 {amount} серебра переведено {member.mention}."
@@ -935,76 +1650,151 @@ async def balance_top(ctx):
     if not await has_role(ctx.author, FINANCIER_ROLE_ID):
         await ctx.send(messages.get("balance_top_no_permission", "У вас нет прав для просмотра топа баланса."))
         return
-    top_list = balance_manager.top_balances()
-    msg = "Топ участников по балансу:\n"
-    for member_id, bal, nickname in top_list:
-        name = nickname if nickname else str(member_id)
-        msg += f"{name}: {bal} серебра\n"
-    await ctx.send(msg)
+
+    view = balance_top_paginator(ctx.guild, author_id=ctx.author.id)
+    response = await view.render_current() or "Топ участников по балансу пуст."
+    await ctx.send(response, view=view if view.has_pages else None)
+
+@balance.command(name="cache")
+async def balance_cache(ctx):
+    """Показывает статистику кэша балансов"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ У вас нет прав для использования этой команды.")
+        return
+    stats = balance_manager.cache.stats()
+    await ctx.send(
+        f"🗃️ Кэш балансов: {stats['size']}/{stats['maxsize']} записей\n"
+        f"Попадания: {stats['hits']} | Промахи: {stats['misses']} | Hit rate: {stats['hit_rate']}%"
+    )
 
 @balance.command(name="history")
 async def balance_history(ctx, member: discord.Member = None):
     target = member if member else ctx.author
-    history = balance_manager.get_history(target.id)
-    if not history:
+
+    async def fetch(cursor, limit):
+        return await balance_manager.get_history(target.id, cursor, limit)
+
+    def render(items, page):
+        history_lines = "\n".join([f"{t} {amt} ({note}) - {timestamp}" for _, t, amt, note, timestamp in items])
+        return messages["balance_history"].format(user_mention=target.mention, history=history_lines) + f"\n📄 Стр. {page}"
+
+    view = PaginatorView(fetch, key=lambda item: (item[4], item[0]), render=render, author_id=ctx.author.id)
+    response = await view.render_current()
+    if not response:
         await ctx.send(messages.get("balance_history_empty", "История транзакций пуста."))
         return
-    history_lines = "\n".join([f"{t} {amt} ({note}) - {timestamp}" for t, amt, note, timestamp in history])
-    await ctx.send(messages["balance_history"].format(user_mention=target.mention, history=history_lines))
+    await ctx.send(response, view=view if view.has_pages else None)
 
 # ==============================
 # Функции и команды для управления сборами (Party)
 # ==============================
-def create_party(creator_id, info):
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("INSERT INTO parties (creator_id, info) VALUES (?, ?)", (str(creator_id), info))
-        party_id = c.lastrowid
-        c.execute("INSERT INTO party_members (party_id, member_id) VALUES (?, ?)", (party_id, str(creator_id)))
-        conn.commit()
-    return party_id
-
-def delete_party(party_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM parties WHERE party_id = ?", (party_id,))
-        c.execute("DELETE FROM party_members WHERE party_id = ?", (party_id,))
-        conn.commit()
-    return True
-
-def add_party_member(party_id, member_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO party_members (party_id, member_id) VALUES (?, ?)", (party_id, str(member_id)))
-        conn.commit()
-
-def remove_party_member(party_id, member_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM party_members WHERE party_id = ? AND member_id = ?", (party_id, str(member_id)))
-        conn.commit()
-
-def get_active_parties():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT party_id, creator_id, info, created_at FROM parties")
-        rows = c.fetchall()
-        return [(row["party_id"], row["creator_id"], row["info"], row["created_at"]) for row in rows]
+class PartyRegistry:
+    """Модель чтения сборов: сборы и число участников в памяти, загрузка одним агрегирующим запросом.
+
+    Обновляется при создании/удалении сбора и входе/выходе участников; отрисованные страницы
+    списка кэшируются до следующего изменения.
+    """
+
+    def __init__(self, database=db):
+        self.db = database
+        self._parties = {}  # party_id -> {"creator_id", "info", "created_at", "count"}
+        self._ids = []  # отсортированные party_id для постраничного вывода
+        self._rendered = {}
+
+    def load(self):
+        rows = self.db.run_blocking(lambda conn: conn.execute("""
+            SELECT p.party_id, p.creator_id, p.info, p.created_at, COUNT(m.member_id) AS count
+            FROM parties p LEFT JOIN party_members m ON m.party_id = p.party_id
+            GROUP BY p.party_id ORDER BY p.party_id
+        """).fetchall())
+        self._parties = {row["party_id"]: {"creator_id": row["creator_id"], "info": row["info"],
+                                           "created_at": row["created_at"], "count": row["count"]} for row in rows}
+        self._ids = sorted(self._parties)
+        self._rendered.clear()
+
+    def get(self, party_id):
+        return self._parties.get(party_id)
+
+    def page(self, after_party_id=None, limit=10):
+        start = bisect_left(self._ids, (after_party_id or 0) + 1)
+        return [(party_id, self._parties[party_id]["info"], self._parties[party_id]["count"])
+                for party_id in self._ids[start:start + limit]]
+
+    def render(self, key, build):
+        if key not in self._rendered:
+            self._rendered[key] = build()
+        return self._rendered[key]
+
+    def _changed(self, party_id, delta):
+        self._parties[party_id]["count"] += delta
+        self._rendered.clear()
+
+    async def create(self, creator_id, info):
+        def _create(conn):
+            party_id = conn.execute("INSERT INTO parties (creator_id, info) VALUES (?, ?)", (str(creator_id), info)).lastrowid
+            conn.execute("INSERT INTO party_members (party_id, member_id) VALUES (?, ?)", (party_id, str(creator_id)))
+            created_at = conn.execute("SELECT created_at FROM parties WHERE party_id = ?", (party_id,)).fetchone()[0]
+            return party_id, created_at
+        party_id, created_at = await self.db.run(_create)
+        self._parties[party_id] = {"creator_id": str(creator_id), "info": info, "created_at": created_at, "count": 1}
+        insort(self._ids, party_id)
+        self._rendered.clear()
+        return party_id
+
+    async def delete(self, party_id):
+        def _delete(conn):
+            conn.execute("DELETE FROM party_members WHERE party_id = ?", (party_id,))
+            return conn.execute("DELETE FROM parties WHERE party_id = ?", (party_id,)).rowcount
+        deleted = await self.db.run(_delete)
+        if self._parties.pop(party_id, None) is not None:
+            self._ids.remove(party_id)
+            self._rendered.clear()
+        return bool(deleted)
+
+    async def join(self, party_id, member_id):
+        """Добавляет участника; None — сбора нет, False — участник уже в сборе"""
+        if party_id not in self._parties:
+            return None
+        # Проверка существования сбора и вставка — один оператор в одной транзакции
+        added = await self.db.run(lambda conn: conn.execute("""
+            INSERT OR IGNORE INTO party_members (party_id, member_id)
+            SELECT party_id, ? FROM parties WHERE party_id = ?
+        """, (str(member_id), party_id)).rowcount)
+        if added and party_id in self._parties:
+            self._changed(party_id, added)
+        return bool(added)
+
+    async def leave(self, party_id, member_id):
+        """Удаляет участника; None — сбора нет, False — участника не было в сборе"""
+        if party_id not in self._parties:
+            return None
+        removed = await self.db.run(lambda conn: conn.execute(
+            "DELETE FROM party_members WHERE party_id = ? AND member_id = ?", (party_id, str(member_id))).rowcount)
+        if removed and party_id in self._parties:
+            self._changed(party_id, -removed)
+        return bool(removed)
+
+parties = PartyRegistry()
+parties.load()
+
+async def get_parties_page(after_party_id=None, limit=10):
+    """Страница сборов с числом участников, начиная после party_id"""
+    return parties.page(after_party_id, limit)
 
 @bot.group(invoke_without_command=True)
 async def party(ctx):
-    parties = get_active_parties()
-    if parties:
-        msg = messages.get("party_active_header", "Активные сборы:\n")
-        for p_id, creator_id, info, _ in parties:
-            with sqlite3.connect(DB_NAME) as conn:
-                c = conn.cursor()
-                c.execute("SELECT COUNT(*) FROM party_members WHERE party_id = ?", (p_id,))
-                count = c.fetchone()[0]
-            msg += messages["party_line"].format(party_id=p_id, info=info, count=count)
-        await ctx.send(msg)
+    def render(items, page):
+        def build():
+            msg = messages.get("party_active_header", "Активные сборы:\n")
+            for p_id, info, count in items:
+                msg += messages["party_line"].format(party_id=p_id, info=info, count=count)
+            return msg
+        return parties.render((items[0][0], len(items)), build)
+
+    view = PaginatorView(get_parties_page, key=lambda item: item[0], render=render, author_id=ctx.author.id)
+    response = await view.render_current()
+    if response:
+        await ctx.send(response, view=view if view.has_pages else None)
     else:
         await ctx.send(messages.get("party_no_active", "Нет активных сборов."))
 
@@ -1013,86 +1803,170 @@ async def party_create(ctx, *, info: str):
     if not await has_role(ctx.author, CONTENT_MAKER_ROLE_ID):
         await ctx.send("У вас нет прав для создания сбора.")
         return
-    party_id = create_party(ctx.author.id, info)
+    party_id = await parties.create(ctx.author.id, info)
     await ctx.send(messages["party_create_success"].format(party_id=party_id, info=info))
 
 @party.command(name="delete")
 async def party_delete(ctx, party_id: int):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT creator_id FROM parties WHERE party_id = ?", (party_id,))
-        row = c.fetchone()
-    if not row:
+    party_info = parties.get(party_id)
+    if not party_info:
         await ctx.send(messages["party_not_found"])
         return
-    creator_id = int(row[0])
+    creator_id = int(party_info["creator_id"])
     if ctx.author.id != creator_id and not await has_role(ctx.author, CONTENT_MAKER_ROLE_ID):
         await ctx.send(messages["party_no_permission_delete"])
         return
-    if delete_party(party_id):
+    if await parties.delete(party_id):
         await ctx.send(messages["party_delete_success"].format(party_id=party_id))
     else:
         await ctx.send("Ошибка при удалении сбора.")
 
 @party.command(name="join")
 async def party_join(ctx, party_id: int):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT party_id FROM parties WHERE party_id = ?", (party_id,))
-        row = c.fetchone()
-    if not row:
+    if await parties.join(party_id, ctx.author.id) is None:
         await ctx.send(messages["party_not_found"])
         return
-    add_party_member(party_id, ctx.author.id)
     await ctx.send(messages["party_join_success"].format(user_mention=ctx.author.mention, party_id=party_id))
 
 @party.command(name="leave")
 async def party_leave(ctx, party_id: int):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT party_id FROM parties WHERE party_id = ?", (party_id,))
-        row = c.fetchone()
-    if not row:
+    if await parties.leave(party_id, ctx.author.id) is None:
         await ctx.send(messages["party_not_found"])
         return
-    remove_party_member(party_id, ctx.author.id)
     await ctx.send(messages["party_leave_success"].format(user_mention=ctx.author.mention, party_id=party_id))
 
 @party.command(name="notify")
 async def party_notify(ctx, party_id: int, *, message_text: str):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT member_id FROM party_members WHERE party_id = ?", (party_id,))
-        members = c.fetchall()
-    if not members:
+    members = await db.fetchall("SELECT member_id FROM party_members WHERE party_id = ?", (party_id,))
+    recipients = [member_id for (member_id,) in members if int(member_id) != ctx.author.id]
+    if not recipients:  # в сборе никого, кроме автора
         await ctx.send(messages["party_notify_no_members"])
         return
-    for (member_id,) in members:
-        if int(member_id) == ctx.author.id:
-            continue
-        member = ctx.guild.get_member(int(member_id))
-        if member:
+    report = await notify_members(recipients, f"Сбор ID {party_id}",
+                                  text=f"Уведомление по сбору ID {party_id}: {message_text}")
+    await ctx.send(
+        f"{messages['party_notify_success']}\n"
+        f"📬 В ЛС: {report.delivered} | ЛС закрыты: {report.forbidden} | "
+        f"Telegram: {report.telegram_delivered} | Ошибки: {report.failed + report.telegram_failed}"
+    )
+
+# ==============================
+# Посещаемость
+# ==============================
+ATTENDANCE_EPOCH = datetime(2025, 1, 1).date().toordinal()  # день с номером бита 0
+ATTENDANCE_MAX_DAYS = 90
+
+class AttendanceTracker:
+    """Посещаемость в памяти: у каждого участника целое число-битовая маска, бит n — отметка в день EPOCH + n.
+
+    Маски собираются из таблицы при запуске и дополняются при каждой отметке; число отметок за
+    последние N дней — это popcount маски, обрезанной окном, без обращения к базе.
+    """
+
+    def __init__(self, database=db):
+        self.db = database
+        self._days = {}  # member_id -> битовая маска дней
+
+    @staticmethod
+    def _bit(day):
+        return day.toordinal() - ATTENDANCE_EPOCH
+
+    def _mark(self, member_id, day):
+        bit = self._bit(day)
+        if bit >= 0:
+            self._days[member_id] = self._days.get(member_id, 0) | (1 << bit)
+
+    def load(self):
+        """Однократно строит маски из таблицы (до запуска event loop)"""
+        rows = self.db.run_blocking(lambda conn: conn.execute("SELECT member_id, check_in_date FROM attendance").fetchall())
+        self._days.clear()
+        for member_id, check_in_date in rows:
             try:
-                await member.send(f"Уведомление по сбору ID {party_id}: {message_text}")
-            except discord.Forbidden:
-                logging.warning(f"Не удалось отправить уведомление {member.name}.")
-    await ctx.send(messages["party_notify_success"])
+                self._mark(str(member_id), datetime.strptime(check_in_date[:10], "%Y-%m-%d").date())
+            except (TypeError, ValueError):
+                logging.warning(f"Некорректная дата посещаемости: {member_id} {check_in_date}")
+
+    async def check_in(self, member_id, day=None):
+        """Отмечает участника; False — отметка за этот день уже есть"""
+        day = day or datetime.now().date()
+        added = await self.db.run(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO attendance (member_id, check_in_date) VALUES (?, ?)",
+            (str(member_id), day.isoformat())).rowcount)
+        if added:
+            self._mark(str(member_id), day)
+        return bool(added)
+
+    def count(self, member_id, days=7, today=None):
+        """Число дней с отметкой среди последних days дней, включая сегодня"""
+        last = self._bit(today or datetime.now().date())
+        if last < 0:
+            return 0
+        first = max(last - days + 1, 0)
+        window = ((1 << (last - first + 1)) - 1) << first
+        return (self._days.get(str(member_id), 0) & window).bit_count()
+
+    def top(self, limit=10, days=7, today=None):
+        """[(member_id, count)] по убыванию числа отметок — один проход по участникам"""
+        counts = ((member_id, self.count(member_id, days, today)) for member_id in self._days)
+        return heapq.nlargest(limit, (item for item in counts if item[1]), key=lambda item: item[1])
+
+attendance_tracker = AttendanceTracker()
+attendance_tracker.load()
+
+def attendance_percentage(count, days):
+    return round(count * 100 / days)
+
+async def check_attendance_days(ctx, days):
+    if not 1 <= days <= ATTENDANCE_MAX_DAYS:
+        await ctx.send(f"⚠️ Период должен быть от 1 до {ATTENDANCE_MAX_DAYS} дней.")
+        return False
+    return True
+
+@bot.group(invoke_without_command=True)
+async def attendance(ctx):
+    """Отмечает посещаемость за сегодня"""
+    today = datetime.now().date()
+    date = today.strftime("%d.%m.%Y")
+    if await attendance_tracker.check_in(ctx.author.id, today):
+        await ctx.send(messages["attendance_checkin_success"].format(date=date))
+    else:
+        await ctx.send(messages["attendance_already_checked_in"].format(date=date))
+
+@attendance.command(name="my")
+async def attendance_my(ctx, days: int = 7):
+    if not await check_attendance_days(ctx, days):
+        return
+    count = attendance_tracker.count(ctx.author.id, days)
+    await ctx.send(messages["attendance_my_result"].format(
+        user_mention=ctx.author.mention, count=count, days=days, percentage=attendance_percentage(count, days)))
+
+@attendance.command(name="member")
+async def attendance_member(ctx, member: discord.Member, days: int = 7):
+    if not await check_attendance_days(ctx, days):
+        return
+    count = attendance_tracker.count(member.id, days)
+    await ctx.send(messages["attendance_member_result"].format(
+        user_mention=member.mention, count=count, days=days, percentage=attendance_percentage(count, days)))
+
+@attendance.command(name="top")
+async def attendance_top(ctx, days: int = 7):
+    if not await check_attendance_days(ctx, days):
+        return
+    top = attendance_tracker.top(limit=10, days=days)
+    if not top:
+        await ctx.send("ℹ️ За этот период отметок нет.")
+        return
+    msg = messages["attendance_top_header"].format(days=days)
+    for member_id, count in top:
+        member = ctx.guild.get_member(int(member_id)) if ctx.guild else None
+        msg += messages["attendance_top_entry"].format(
+            username=member.display_name if member else member_id,
+            count=count, days=days, percentage=attendance_percentage(count, days))
+    await ctx.send(msg)
 
 # ==============================
 # Команды для управления штрафами
 # ==============================
-def sync_fines_with_balance(user_id):
-    """Синхронизирует баланс пользователя с его активными штрафами"""
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        # Получаем сумму активных штрафов
-        c.execute("SELECT COALESCE(SUM(amount), 0) FROM fines WHERE user_id = ? AND is_closed = 0", (str(user_id),))
-        total_fines = c.fetchone()[0]
-        
-        # Обновляем баланс пользователя
-        c.execute("INSERT OR REPLACE INTO balances (member_id, balance) VALUES (?, -?)", (str(user_id), total_fines))
-        conn.commit()
-
 @bot.command(name="fine")
 async def issue_fine(ctx, user: discord.Member, amount: int, *, reason: str = "Без причины"):
     if not await has_role(ctx.author, FINANCIER_ROLE_ID):
@@ -1100,16 +1974,8 @@ async def issue_fine(ctx, user: discord.Member, amount: int, *, reason: str = "
         return
 
     try:
-        # Логируем штраф в базу
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO fines (user_id, amount, reason) VALUES (?, ?, ?)", 
-                     (str(user.id), amount, reason))
-            fine_id = c.lastrowid
-            conn.commit()
-
-        # Синхронизируем баланс
-        sync_fines_with_balance(user.id)
+        # Записываем штраф и списываем его с баланса
+        fine_id = await balance_manager.issue_fine(user.id, amount, reason, nickname=user.display_name, by=ctx.author.id)
 
         # Создаём embed-уведомление
         embed = discord.Embed(
@@ -1132,13 +1998,11 @@ async def issue_fine(ctx, user: discord.Member, amount: int, *, reason: str = "
         if fine_role and fine_role not in user.roles:
             await user.add_roles(fine_role)
 
-        # Отправляем уведомление пользователю
-        await send_notification(user.id, None, embed=embed)
+        # Ставим уведомление пользователю в очередь
+        await outbox.enqueue(user.id, embed=embed, dedupe_key=f"fine:{fine_id}")
 
         # Логируем
-        log_channel = ctx.guild.get_channel(LOG_CHANNEL_ID)
-        if log_channel:
-            await log_channel.send(f"✅ Штраф для {user.mention} отправлен в {fine_channel.mention}!")
+        fine_log.write(f"✅ Штраф для {user.mention} отправлен в {fine_channel.mention}!")
 
         await ctx.send("✅ Штраф успешно выдан.", ephemeral=True)
         logging.info(f"Штраф выдан: {user} | Сумма: {amount} | Причина: {reason} | Выдал: {ctx.author}")
@@ -1148,26 +2012,18 @@ async def issue_fine(ctx, user: discord.Member, amount: int, *, reason: str = "
 
 @bot.command(name="close_fine")
 async def close_fine(ctx, fine_id: int):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT user_id, is_closed FROM fines WHERE id = ?", (fine_id,))
-        result = c.fetchone()
-        
-        if result is None:
-            await ctx.send(f"❗ Штраф с номером `{fine_id}` не найден.")
-            return
-        
-        user_id, is_closed = result
-        
-        if is_closed == 1:
-            await ctx.send(f"❗ Штраф с номером `{fine_id}` уже закрыт.")
-            return
-        
-        c.execute("UPDATE fines SET is_closed = 1 WHERE id = ?", (fine_id,))
-        conn.commit()
+    # Закрытие и возврат суммы на баланс — одна транзакция
+    result = await balance_manager.close_fine(fine_id, by=ctx.author.id)
+
+    if result is None:
+        await ctx.send(f"❗ Штраф с номером `{fine_id}` не найден.")
+        return
 
-    # Синхронизируем баланс после закрытия штрафа
-    sync_fines_with_balance(user_id)
+    user_id, closed = result
+
+    if not closed:
+        await ctx.send(f"❗ Штраф с номером `{fine_id}` уже закрыт.")
+        return
 
     # Получаем объект пользователя
     user = ctx.guild.get_member(int(user_id))
@@ -1210,52 +2066,113 @@ async def update_message_command(ctx, key: str, *, new_message: str):
         json.dump(current, f, indent=4, ensure_ascii=False)
     await ctx.send(messages["update_message_success"].format(key=key))
 
-@bot.command(name="m")
+# ==============================
+# Рассылки !m: фоновые задания поверх очереди уведомлений
+# ==============================
+class BroadcastJobs:
+    """Рассылка !m — группа строк outbox с общим префиксом dedupe_key "m:<id задания>:".
+
+    Доставкой занимаются воркеры outbox (в пределах лимитов Discord и Telegram), задание лишь
+    периодически обновляет одно сообщение с прогрессом и может быть отменено.
+    """
+
+    STATUS_LABELS = {
+        "delivered": "доставлено", "forbidden": "закрыто", "failed": "ошибки",
+        "skipped": "пропущено", "cancelled": "отменено", "pending": "в очереди",
+    }
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._jobs = {}  # id задания -> (id автора, задача отслеживания)
+
+    @staticmethod
+    def prefix(job_id):
+        return f"m:{job_id}:"
+
+    async def start(self, ctx, recipients, text):
+        """Ставит сообщение в очередь для получателей и запускает отслеживание прогресса"""
+        job_id = ctx.message.id
+        queued = await outbox.enqueue_many([
+            (member.id, text, None, f"{self.prefix(job_id)}{member.id}") for member in recipients
+        ])
+        message = await ctx.send(f"📤 Рассылка `{job_id}`: {queued} получателей поставлено в очередь. "
+                                 f"Отмена: `!m cancel {job_id}`")
+        self._jobs[job_id] = (ctx.author.id, asyncio.create_task(self._track(job_id, message)))
+        logging.info(f"Рассылка {job_id} от {ctx.author}: {queued} получателей")
+        return job_id
+
+    def author_of(self, job_id):
+        job = self._jobs.get(job_id)
+        return job[0] if job else None
+
+    async def cancel(self, job_id):
+        """Отменяет ещё не доставленные сообщения задания; возвращает их количество"""
+        return await outbox.cancel_group(self.prefix(job_id))
+
+    def render(self, job_id, stats, finished):
+        lines = [f"{'✅' if finished else '⏳'} Рассылка `{job_id}` {'завершена' if finished else 'выполняется'}"]
+        for platform, title in (("discord", "Discord"), ("telegram", "Telegram")):
+            counts = stats.get(platform, {})
+            parts = [f"{label} {counts[status]}" for status, label in self.STATUS_LABELS.items() if counts.get(status)]
+            lines.append(f"{title}: {', '.join(parts) or '—'}")
+        if not finished:
+            lines.append(f"Отмена: `!m cancel {job_id}`")
+        return "\n".join(lines)
+
+    async def _track(self, job_id, message):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                stats = await outbox.group_stats(self.prefix(job_id))
+                finished = not any(counts.get("pending") for counts in stats.values())
+                try:
+                    await message.edit(content=self.render(job_id, stats, finished))
+                except discord.HTTPException as e:
+                    logging.error(f"Не удалось обновить прогресс рассылки {job_id}: {e}")
+                if finished:
+                    logging.info(f"Рассылка {job_id} завершена: {stats}")
+                    return
+        except Exception as e:
+            logging.error(f"Ошибка отслеживания рассылки {job_id}: {e}")
+        finally:
+            self._jobs.pop(job_id, None)
+
+broadcasts = BroadcastJobs()
+
+@bot.group(name="m", invoke_without_command=True)
 async def send_message(ctx, members: commands.Greedy[discord.Member], roles: commands.Greedy[discord.Role], *, message_text: str):
     """Отправляет личное сообщение указанным пользователям и участникам упомянутых ролей."""
-    recipients = set(members)  # Используем set, чтобы избежать дублирования
-
-    # Добавляем всех участников, у которых есть упомянутые роли
+    # Один участник из нескольких ролей получает сообщение один раз
+    recipients = {member.id: member for member in members}
     for role in roles:
-        recipients.update(role.members)
+        recipients.update((member.id, member) for member in role.members)
+    recipients = [member for member in recipients.values() if not member.bot]  # Пропускаем ботов
 
     if not recipients:
         await ctx.send("⚠️ Использование: `!m @пользователь1 @роль1 ... сообщение`")
         return
 
-    sent_count = 0
-    failed_count = 0
-    telegram_sent = 0
-    telegram_failed = 0
-
-    for member in recipients:
-        if member.bot:
-            continue  # Пропускаем ботов
-
-        try:
-            # Отправляем уведомление через send_notification
-            await send_notification(
-                str(member.id),
-                f"📩 **Сообщение от {ctx.author.display_name}:**\n{message_text}"
-            )
-            sent_count += 1
-        except Exception as e:
-            failed_count += 1
-            logging.error(f"Ошибка отправки сообщения {member.name}: {e}")
-
-    response = []
-#    if sent_count:
-#        response.append(f"✅ Сообщение отправлено {sent_count} пользователям.")
-#    if failed_count:
-#        response.append(f"❌ Не удалось отправить сообщение {failed_count} пользователям.")
-    
-    await ctx.send("\n".join(response))
+    text = f"📩 **Сообщение от {ctx.author.display_name}:**\n{message_text}"
+    await broadcasts.start(ctx, recipients, text)
 
     try:
         await ctx.message.delete()
     except:
         pass
 
+@send_message.command(name="cancel")
+async def send_message_cancel(ctx, job_id: int):
+    """Отменяет недоставленную часть рассылки"""
+    author_id = broadcasts.author_of(job_id)
+    if author_id != ctx.author.id and not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ Отменить рассылку может только её автор или администратор.")
+        return
+    cancelled = await broadcasts.cancel(job_id)
+    if cancelled:
+        await ctx.send(f"🛑 Рассылка `{job_id}` отменена: {cancelled} сообщений не будет отправлено.")
+    else:
+        await ctx.send(f"ℹ️ В рассылке `{job_id}` нет сообщений в очереди.")
+
 @bot.command(name="link_telegram")
 async def link_telegram_cmd(ctx):
     """Генерирует код для привязки Telegram"""
@@ -1303,7 +2220,8 @@ async def help_command(ctx):
         "`!balance transfer [пользователь] [сумма]` - Перевод средств между участниками.\n"
         "`!balance top` - Топ участников по балансу (только финансист).\n"
         "`!balance history [пользователь]` - История транзакций.\n"
-        "`!update_balances` - Массовое обновление балансов (только администратор).\n\n"
+        "`!balance cache` - Статистика кэша балансов (только администратор).\n"
+        "`!update_balances [--dry-run]` - Массовое обновление балансов из текста или CSV-файла (только администратор).\n\n"
         "**Сборы:**\n"
         "`!party` - Показать активные сборы.\n"
         "`!party create [информация]` - Создать сбор (только контент-мейкер).\n"
@@ -1311,12 +2229,19 @@ async def help_command(ctx):
         "`!party join [ID сбора]` - Присоединиться к сбору.\n"
         "`!party leave [ID сбора]` - Покинуть сбор.\n"
         "`!party notify [ID сбора] [сообщение]` - Уведомить участников сбора.\n\n"
+        "**Посещаемость:**\n"
+        "`!attendance` - Отметиться за сегодня.\n"
+        "`!attendance my [дней]` - Ваша посещаемость (по умолчанию за 7 дней).\n"
+        "`!attendance member [пользователь] [дней]` - Посещаемость участника.\n"
+        "`!attendance top [дней]` - Топ участников по посещаемости.\n\n"
         "**Штрафы:**\n"
         "`!fine [пользователь] [сумма] [причина]` - Выдать штраф (только финансист).\n"
         "`!close_fine [номер штрафа]` - Закрыть штраф и снять роль штрафника (только финансист).\n\n"
         "**Сообщения:**\n"
         "`!update_message [ключ] [новое сообщение]` - Обновить сообщение (только с определённой ролью).\n"
         "`!m [пользователь1] [пользователь2] ... [сообщение]` - Отправить сообщение в ЛС.\n"
+        "`!m cancel [id рассылки]` - Отменить недоставленную часть рассылки.\n"
+        "`!dm_stats` - Статистика последних рассылок ЛС (только администратор).\n"
         "`!help` - Показать это сообщение."
     )
     await ctx.send(help_message)
@@ -1328,275 +2253,600 @@ async def get_user_id(ctx, username: str):
         await ctx.send("❌ У вас нет прав для использования этой команды.")
         return
         
-    members = ctx.guild.members
-    found = False
-    for member in members:
-        if username.lower() in member.name.lower() or (member.nick and username.lower() in member.nick.lower()):
-            await ctx.send(f"Найден пользователь: {member.name}#{member.discriminator} (ID: {member.id})")
-            found = True
-    
+    found = [member for member in map(ctx.guild.get_member, member_index(ctx.guild).search(username)) if member]
     if not found:
         await ctx.send(f"❌ Пользователь с ником '{username}' не найден.")
+        return
+    await ctx.send("\n".join(f"Найден пользователь: {member.name}#{member.discriminator} (ID: {member.id})" for member in found))
+
+def iter_balance_rows(lines, delimiter=","):
+    """Построчно разбирает импорт балансов: `ник | ...: сумма` или CSV `ник,...,сумма`.
+
+    Выдаёт (номер строки, имя, сумма), а для ошибочных строк — (номер строки, None, текст ошибки).
+    """
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if ':' in line:
+            name_part, amount_str = line.split(':', 1)
+            username = name_part.split('|')[0].strip().strip('@')
+        else:
+            row = next(csv.reader([line], delimiter=delimiter))
+            if len(row) < 2:
+                yield line_no, None, f"Неверный формат строки {line_no}: {line}"
+                continue
+            username, amount_str = row[0].strip().strip('@'), row[-1]
+        try:
+            amount = int(amount_str.strip().replace(' ', ''))
+        except ValueError:
+            if line_no == 1 and ':' not in line:
+                continue  # заголовок CSV
+            yield line_no, None, f"Неверная сумма в строке {line_no}: {line}"
+            continue
+        yield line_no, username, amount
+
+def _limited_lines(lines, limit):
+    if len(lines) <= limit:
+        return lines
+    return lines[:limit] + [f"… и ещё {len(lines) - limit}"]
+
+async def import_balances(ctx, data):
+    """Массовая установка балансов из текста или приложенного CSV; `--dry-run` только показывает изменения"""
+    data = data.strip()
+    dry_run = data.startswith("--dry-run")
+    if dry_run:
+        data = data[len("--dry-run"):].strip()
+
+    if ctx.message.attachments:
+        text = (await ctx.message.attachments[0].read()).decode("utf-8-sig", errors="replace")
+        sample = text[:1000]
+        delimiter = ';' if sample.count(';') > sample.count(',') else ','
+        lines = io.StringIO(text)
+    elif data:
+        # В тексте сообщения строки можно разделять точкой с запятой
+        delimiter = ','
+        lines = io.StringIO(data.replace(';', '\n'))
+    else:
+        await ctx.send("⚠️ Использование: `!update_balances [--dry-run] ник: сумма; ...` или приложите CSV-файл.")
+        return
 
-@bot.command(name="update_balances")
-@commands.has_permissions(administrator=True)
-async def update_balances(ctx, *, data: str):
-    """Обновляет балансы пользователей из списка"""
     try:
-        # Разбиваем данные по строкам или точкам с запятой
-        lines = [line.strip() for line in data.replace(';', '\n').split('\n')]
-        updated = 0
+        started = time.monotonic()
+        targets = {}
         errors = []
+        for line_no, username, value in iter_balance_rows(lines, delimiter):
+            if username is None:
+                errors.append(value)
+                continue
+            member, candidates = resolve_member(ctx.guild, username)
+            if member:
+                if member.id in targets:
+                    errors.append(f"Строка {line_no}: {member.display_name} указан повторно — берётся последнее значение")
+                targets[member.id] = (value, member.display_name)
+            elif candidates:
+                names = ", ".join(candidate.display_name for candidate in candidates[:5])
+                more = f" и ещё {len(candidates) - 5}" if len(candidates) > 5 else ""
+                errors.append(f"Строка {line_no}: неоднозначное имя '{username}': {names}{more}")
+            else:
+                errors.append(f"Строка {line_no}: пользователь не найден: {username}")
 
-        for line in lines:
-            try:
-                # Пропускаем пустые строки
-                if not line.strip():
-                    continue
-                
-                # Парсим строку
-                if ':' not in line:
-                    errors.append(f"Неверный формат строки (нет ':'): {line}")
-                    continue
-
-                # Разделяем на имя и сумму
-                name_part, amount_str = line.split(':', 1)
-                
-                # Очищаем сумму от пробелов и получаем число
-                amount = int(amount_str.strip().replace(' ', ''))
-                
-                # Получаем имя пользователя
-                username = name_part.split('|')[0].strip().strip('@')
-                
-                # Ищем пользователя
-                member = None
-                for guild_member in ctx.guild.members:
-                    if username.lower() in guild_member.name.lower() or (guild_member.nick and username.lower() in guild_member.nick.lower()):
-                        member = guild_member
-                        break
-                    # Проверяем ID пользователя
-                    if username.isdigit() and str(guild_member.id) == username:
-                        member = guild_member
-                        break
-
-                if member:
-                    # Устанавливаем новый баланс (сначала обнуляем, потом добавляем)
-                    balance_manager.withdraw(member.id, balance_manager.get_balance(member.id), nickname=member.display_name, by=ctx.author.id, note="Balance reset")
-                    balance_manager.deposit(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Balance update")
-                    updated += 1
-                else:
-                    errors.append(f"Пользователь не найден: {username}")
+        if dry_run:
+            old = await balance_manager.get_balances(list(targets))
+            changes = [(str(member_id), old[str(member_id)], new) for member_id, (new, _) in targets.items()
+                       if old[str(member_id)] != new]
+            report = f"🔍 Пробный прогон: изменится балансов {len(changes)} из {len(targets)} найденных\n"
+        else:
+            changes = await balance_manager.set_balances(
+                [(member_id, new, nickname) for member_id, (new, nickname) in targets.items()],
+                by=ctx.author.id, note="Balance import"
+            )
+            report = (f"✅ Обновлено балансов: {len(changes)} (без изменений: {len(targets) - len(changes)}) "
+                      f"за {time.monotonic() - started:.2f} с\n")
+
+        diff_lines = []
+        for member_id, was, new in changes:
+            member = ctx.guild.get_member(int(member_id))
+            diff_lines.append(f"{member.display_name if member else member_id}: {was:,} → {new:,}")
+        if diff_lines:
+            report += "\n" + "\n".join(_limited_lines(diff_lines, 20)) + "\n"
+        if errors:
+            report += "\n❌ Ошибки:\n" + "\n".join(_limited_lines(errors, 15))
 
-            except ValueError as e:
-                errors.append(f"Ошибка в строке '{line}': {str(e)}")
-            except Exception as e:
-                errors.append(f"Непредвиденная ошибка в строке '{line}': {str(e)}")
+        # Полный список изменений — CSV-файлом, если он не помещается в сообщение
+        diff_file = None
+        if len(diff_lines) > 20:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(["member_id", "old_balance", "new_balance"])
+            writer.writerows(changes)
+            diff_file = discord.File(io.BytesIO(buffer.getvalue().encode("utf-8")), filename="balance_diff.csv")
 
-        # Отправляем отчет
-        report = f"✅ Обновлено балансов: {updated}\n"
-        if errors:
-            report += "\n❌ Ошибки:\n" + "\n".join(errors)
-        
-        await ctx.send(report)
+        await ctx.send(report[:2000], file=diff_file)
 
     except Exception as e:
         await ctx.send(f"❌ Ошибка при обработке данных: {str(e)}")
 
+@bot.command(name="update_balances")
+@commands.has_permissions(administrator=True)
+async def update_balances(ctx, *, data: str = ""):
+    """Обновляет балансы пользователей из списка или приложенного CSV"""
+    await import_balances(ctx, data)
+
 @bot.command(name="balance_update")
 @commands.has_permissions(administrator=True)
-async def balance_update(ctx, *, data: str):
+async def balance_update(ctx, *, data: str = ""):
     """Обновляет балансы пользователей из предустановленного списка"""
-    await update_balances(ctx, data=data)
-
-async def update_balances(ctx, data=None):
-    """Обновляет балансы пользователей из списка"""
-    try:
-        # Разбиваем данные по строкам или точкам с запятой
-        lines = [line.strip() for line in data.replace(';', '\n').split('\n')]
-        updated = 0
-        errors = []
-
-        for line in lines:
-            try:
-                # Пропускаем пустые строки
-                if not line.strip():
-                    continue
-                
-                # Парсим строку
-                if ':' not in line:
-                    errors.append(f"Неверный формат строки (нет ':'): {line}")
-                    continue
+    await import_balances(ctx, data)
 
-                # Разделяем на имя и сумму
-                name_part, amount_str = line.split(':', 1)
-                
-                # Очищаем сумму от пробелов и получаем число
-                amount = int(amount_str.strip().replace(' ', ''))
-                
-                # Получаем имя пользователя
-                username = name_part.split('|')[0].strip().strip('@')
-                
-                # Ищем пользователя
-                member = None
-                for guild_member in ctx.guild.members:
-                    if username.lower() in guild_member.name.lower() or (guild_member.nick and username.lower() in guild_member.nick.lower()):
-                        member = guild_member
-                        break
-                    # Проверяем ID пользователя
-                    if username.isdigit() and str(guild_member.id) == username:
-                        member = guild_member
-                        break
-
-                if member:
-                    # Устанавливаем новый баланс (сначала обнуляем, потом добавляем)
-                    balance_manager.withdraw(member.id, balance_manager.get_balance(member.id), nickname=member.display_name, by=ctx.author.id, note="Balance reset")
-                    balance_manager.deposit(member.id, amount, nickname=member.display_name, by=ctx.author.id, note="Balance update")
-                    updated += 1
-                else:
-                    errors.append(f"Пользователь не найден: {username}")
+# ==============================
+# Связи Discord-Telegram: двунаправленная карта в памяти
+# ==============================
+class TelegramLinks:
+    """Связи Discord <-> Telegram в памяти: загружаются один раз, обновляются после каждой записи в базу.
+
+    Одному Telegram-аккаунту соответствует ровно один Discord-аккаунт, поэтому обе стороны — обычные словари.
+    """
+
+    def __init__(self, database=db):
+        self.db = database
+        self._by_discord = {}  # discord_id -> telegram_id
+        self._by_telegram = {}  # telegram_id -> discord_id
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Однократно загружает связи из базы (до запуска event loop)"""
+        rows = self.db.run_blocking(lambda conn: conn.execute(
+            "SELECT discord_id, telegram_id FROM telegram_links ORDER BY created_at").fetchall())
+        for discord_id, telegram_id in rows:
+            self.remember(discord_id, telegram_id)
+
+    def remember(self, discord_id, telegram_id):
+        # Без await между шагами — обработчики никогда не видят карту наполовину обновлённой
+        old_telegram = self._by_discord.pop(discord_id, None)
+        if old_telegram is not None:
+            self._by_telegram.pop(old_telegram, None)
+        old_discord = self._by_telegram.pop(telegram_id, None)
+        if old_discord is not None:
+            self._by_discord.pop(old_discord, None)
+        self._by_discord[discord_id] = telegram_id
+        self._by_telegram[telegram_id] = discord_id
+
+    def _lookup(self, mapping, key):
+        value = mapping.get(str(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def telegram_of(self, discord_id):
+        return self._lookup(self._by_discord, discord_id)
+
+    def discord_of(self, telegram_id):
+        return self._lookup(self._by_telegram, telegram_id)
+
+    @staticmethod
+    def store(conn, discord_id, telegram_id, telegram_username):
+        """Записывает связь в рамках транзакции вызывающего; прежняя связь этого Telegram удаляется"""
+        conn.execute("DELETE FROM telegram_links WHERE telegram_id = ? AND discord_id != ?", (telegram_id, discord_id))
+        conn.execute("""
+            INSERT OR REPLACE INTO telegram_links
+            (discord_id, telegram_id, telegram_username)
+            VALUES (?, ?, ?)
+        """, (discord_id, telegram_id, telegram_username))
 
-            except ValueError as e:
-                errors.append(f"Ошибка в строке '{line}': {str(e)}")
-            except Exception as e:
-                errors.append(f"Непредвиденная ошибка в строке '{line}': {str(e)}")
+    async def link(self, discord_id, telegram_id, telegram_username):
+        discord_id, telegram_id = str(discord_id), str(telegram_id)
+        await self.db.run(self.store, discord_id, telegram_id, telegram_username)
+        self.remember(discord_id, telegram_id)
 
-        # Отправляем отчет
-        report = f"✅ Обновлено балансов: {updated}\n"
-        if errors:
-            report += "\n❌ Ошибки:\n" + "\n".join(errors)
-        
-        await ctx.send(report)
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = round(self.hits * 100 / total, 1) if total else 0.0
+        return {"size": len(self._by_discord), "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
 
-    except Exception as e:
-        await ctx.send(f"❌ Ошибка при обработке данных: {str(e)}")
+telegram_links = TelegramLinks()
+telegram_links.load()
 
-# Функции для работы с Telegram связями
 async def get_telegram_id(discord_id: str) -> str | None:
     """Получает Telegram ID по Discord ID"""
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT telegram_id FROM telegram_links WHERE discord_id = ?", (str(discord_id),))
-        result = c.fetchone()
-        return result[0] if result else None
+    return telegram_links.telegram_of(discord_id)
 
 async def link_accounts(discord_id: str, telegram_id: int, telegram_username: str) -> bool:
     """Связывает аккаунты Discord и Telegram"""
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("""
-            INSERT OR REPLACE INTO telegram_links 
-            (discord_id, telegram_id, telegram_username) 
-            VALUES (?, ?, ?)
-        """, (str(discord_id), str(telegram_id), telegram_username))
-        conn.commit()
+    await telegram_links.link(discord_id, telegram_id, telegram_username)
     return True
 
 async def generate_link_code(discord_id: str) -> str:
     """Генерирует временный код для привязки Telegram"""
     code = secrets.token_hex(3)  # 6 символов
     
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
+    def _store(conn):
         # Удаляем старые коды для этого пользователя
-        c.execute("DELETE FROM telegram_link_codes WHERE discord_id = ?", (str(discord_id),))
+        conn.execute("DELETE FROM telegram_link_codes WHERE discord_id = ?", (str(discord_id),))
         # Добавляем новый код
-        c.execute(
+        conn.execute(
             "INSERT INTO telegram_link_codes (code, discord_id) VALUES (?, ?)",
             (code, str(discord_id))
         )
-        conn.commit()
-    
+    await db.run(_store)
+
     return code
 
 async def verify_link_code(code: str, telegram_id: int, telegram_username: str) -> bool:
     """Проверяет код и создаёт связь Discord-Telegram"""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
+        def _consume_code(conn):
             # Получаем discord_id по коду
-            c.execute("""
+            result = conn.execute("""
                 SELECT discord_id FROM telegram_link_codes
                 WHERE code = ? AND created_at > datetime('now', '-5 minutes')
-            """, (code,))
-            result = c.fetchone()
+            """, (code,)).fetchone()
             if not result:
-                return False
+                return None
 
             discord_id = result[0]
 
             # Удаляем использованный код
-            c.execute("DELETE FROM telegram_link_codes WHERE code = ?", (code,))
+            conn.execute("DELETE FROM telegram_link_codes WHERE code = ?", (code,))
 
             # Создаём связь
-            c.execute("""
-                INSERT OR REPLACE INTO telegram_links
-                (discord_id, telegram_id, telegram_username)
-                VALUES (?, ?, ?)
-            """, (discord_id, str(telegram_id), telegram_username))
-            conn.commit()
-
-            # Отправляем подтверждение в Telegram
-            try:
-                await dp.bot.send_message(
-                    chat_id=telegram_id,
-                    text="✅ Ваш аккаунт успешно привязан к Discord!",
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logging.error(f"Ошибка отправки подтверждения в Telegram: {e}")
+            TelegramLinks.store(conn, discord_id, str(telegram_id), telegram_username)
+            return discord_id
+
+        discord_id = await db.run(_consume_code)
+        if discord_id is None:
+            return False
+        telegram_links.remember(discord_id, str(telegram_id))
+
+        # Отправляем подтверждение в Telegram
+        try:
+            await telegram_sender.send(telegram_id, "✅ Ваш аккаунт успешно привязан к Discord!")
+        except Exception as e:
+            logging.error(f"Ошибка отправки подтверждения в Telegram: {e}")
 
-            return True
+        return True
     except Exception as e:
         logging.error(f"Ошибка при верификации кода: {e}")
         return False
 
+# ==============================
+# Отправка в Telegram с соблюдением лимитов
+# ==============================
+class TelegramSender:
+    """Очередь исходящих сообщений Telegram: общий лимит бота и отдельный лимит на каждый чат.
+
+    Telegram допускает около 30 сообщений в секунду на бота и около одного в секунду в один чат.
+    На RetryAfter вся отправка ждёт указанное время и повторяет сообщение.
+    """
+
+    def __init__(self, telegram, workers=10, rate=25.0, burst=25, chat_rate=1.0, chat_burst=3,
+                 max_retries=3, max_chats=10000):
+        self.telegram = telegram
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.queue = asyncio.Queue()
+        self.delivered = 0
+        self.forbidden = 0
+        self.failed = 0
+        self.retries = 0
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket, давно неактивные вытесняются
+        self._sent_at = deque(maxlen=1000)  # время последних отправок для подсчёта скорости
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def send(self, chat_id, text, **kwargs):
+        """Ставит сообщение в очередь и ждёт исхода: delivered, forbidden или failed"""
+        chat_id = str(chat_id)
+        # Лимит чата ждём до постановки в очередь, чтобы воркеры не простаивали на одном чате
+        await self._chat_bucket(chat_id).acquire()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((future, chat_id, text, kwargs))
+        return await future
+
+    async def _worker(self):
+        while True:
+            future, chat_id, text, kwargs = await self.queue.get()
+            try:
+                outcome = await self._deliver(chat_id, text, kwargs)
+            except Exception as e:
+                logging.error(f"Ошибка отправки в Telegram чату {chat_id}: {e}")
+                outcome = "failed"
+            finally:
+                self.queue.task_done()
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if outcome == "delivered":
+                self._sent_at.append(time.monotonic())
+            if not future.done():
+                future.set_result(outcome)
+
+    async def _deliver(self, chat_id, text, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.telegram.send_message(chat_id=chat_id, text=text, **kwargs)
+                return "delivered"
+            except TelegramForbiddenError:
+                logging.warning(f"Telegram чат {chat_id} заблокировал бота")
+                return "forbidden"
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                self.bucket.pause(e.retry_after)
+        logging.error(f"Сообщение в Telegram чат {chat_id} не доставлено: превышено число повторов")
+        return "failed"
+
+    def stats(self):
+        now = time.monotonic()
+        per_minute = sum(1 for sent_at in self._sent_at if now - sent_at <= 60)
+        return {"queued": self.queue.qsize(), "delivered": self.delivered, "forbidden": self.forbidden,
+                "failed": self.failed, "retries": self.retries, "per_second": round(per_minute / 60, 1)}
+
+telegram_sender = TelegramSender(
+    telegram_bot,
+    workers=config.get("TELEGRAM_WORKERS", 10),
+    rate=config.get("TELEGRAM_RATE_PER_SECOND", 25.0),
+    burst=config.get("TELEGRAM_BURST", 25),
+)
+
+def telegram_text_for(text=None, embed=None):
+    """Формирует текст для Telegram из текста и embed-а Discord"""
+    telegram_text = text or ""
+    if embed:
+        if telegram_text:
+            telegram_text += "\n\n"
+        telegram_text += f"<b>{embed.title}</b>\n\n" if embed.title else ""
+        telegram_text += embed.description or ""
+        for field in embed.fields:
+            telegram_text += f"\n\n{field.name}\n{field.value}"
+    return telegram_text
+
+async def deliver_notification(discord_id: str, text: str = None, embed: discord.Embed = None):
+    """Отправляет уведомление в Discord и Telegram (если привязан).
+
+    Возвращает (исход Discord, исход Telegram): delivered / forbidden / failed и delivered / failed / None.
+    """
+    discord_outcome = "failed"
+    user = bot.get_user(int(discord_id))
+    if user:
+        # Текст и embed уходят одним сообщением, в общем лимите ЛС
+        discord_outcome = await dm_dispatcher.send(user, content=text, embed=embed)
+
+    telegram_outcome = None
+    telegram_id = await get_telegram_id(discord_id)
+    telegram_text = telegram_text_for(text, embed)
+    if telegram_id and telegram_text:
+        outcome = await telegram_sender.send(telegram_id, telegram_text)
+        telegram_outcome = "delivered" if outcome == "delivered" else "failed"
+    return discord_outcome, telegram_outcome
+
 # Функция для отправки уведомлений
 async def send_notification(discord_id: str, text: str = None, embed: discord.Embed = None):
     """Отправляет уведомление пользователю в Discord и Telegram (если привязан)"""
     try:
-        # Получаем пользователя Discord
-        user = bot.get_user(int(discord_id))
-        if not user:
-            return
-            
-        # Отправляем в Discord
-        try:
-            if text:
-                await user.send(text)
-            if embed:
-                await user.send(embed=embed)
-        except discord.Forbidden:
-            pass  # Пользователь закрыл ЛС
-            
-        # Проверяем привязку Telegram
-        telegram_id = await get_telegram_id(discord_id)
-        if not telegram_id:
-            return
+        return await deliver_notification(discord_id, text, embed)
+    except Exception as e:
+        logging.error(f"Ошибка отправки уведомления для {discord_id}: {e}")
+        return "failed", None
+
+async def notify_members(discord_ids, label, text=None, embed=None, concurrency=5):
+    """Рассылает уведомление в Discord и Telegram параллельно, не больше concurrency получателей сразу"""
+    discord_ids = list(dict.fromkeys(str(discord_id) for discord_id in discord_ids))
+    report = DeliveryReport(label, len(discord_ids))
+    dm_dispatcher.recent.append(report)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def notify(discord_id):
+        async with semaphore:
+            report.record(*await send_notification(discord_id, text, embed))
+
+    await asyncio.gather(*(notify(discord_id) for discord_id in discord_ids))
+    logging.info(f"Рассылка завершена — {report.summary()}")
+    return report
+
+class NotificationOutbox:
+    """Постоянная очередь уведомлений в SQLite с пулом воркеров доставки.
+
+    Команды только ставят уведомление в очередь; воркеры доставляют его в Discord и Telegram,
+    повторяя неудачный канал с экспоненциальной задержкой. Недоставленное при перезапуске
+    подхватывается заново, повторная постановка с тем же dedupe_key игнорируется.
+    """
+
+    def __init__(self, database=db, workers=4, max_attempts=6, base_delay=5, max_delay=900):
+        self.db = database
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.delivered = 0
+        self.failed = 0
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    @staticmethod
+    def _row(discord_id, text, embed, dedupe_key, channels):
+        return (
+            dedupe_key, str(discord_id), text, json.dumps(embed.to_dict(), ensure_ascii=False) if embed else None,
+            "pending" if "discord" in channels else "skipped",
+            "pending" if "telegram" in channels else "skipped",
+        )
 
-        # Формируем текст для Telegram
-        telegram_text = text or ""
-        if embed:
-            if telegram_text:
-                telegram_text += "\n\n"
-            telegram_text += f"<b>{embed.title}</b>\n\n" if embed.title else ""
-            telegram_text += embed.description or ""
-            for field in embed.fields:
-                telegram_text += f"\n\n{field.name}\n{field.value}"
-
-        # Отправляем в Telegram
-        if telegram_text:
+    async def enqueue(self, discord_id, text=None, embed=None, dedupe_key=None, channels=("discord", "telegram")):
+        """Ставит уведомление в очередь; возвращает False, если такой dedupe_key уже был"""
+        return await self.enqueue_many([(discord_id, text, embed, dedupe_key)], channels) == 1
+
+    async def enqueue_many(self, items, channels=("discord", "telegram")):
+        """Ставит пачку (discord_id, text, embed, dedupe_key) в очередь одной транзакцией"""
+        added = await self.db.executemany("""
+            INSERT OR IGNORE INTO notification_outbox
+            (dedupe_key, discord_id, text, embed, discord_status, telegram_status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [self._row(*item, channels) for item in items])
+        if added:
+            self._wakeup.set()
+        return added
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._poller())]
+            self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def pending_count(self):
+        row = await self.db.fetchone(
+            "SELECT COUNT(*) FROM notification_outbox WHERE discord_status = 'pending' OR telegram_status = 'pending'")
+        return row[0]
+
+    @staticmethod
+    def _group_range(prefix):
+        # Диапазон по уникальному индексу dedupe_key вместо LIKE: все ключи, начинающиеся с prefix
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    async def group_stats(self, prefix):
+        """Статусы доставки группы уведомлений: {"discord": {статус: число}, "telegram": {...}}"""
+        rows = await self.db.fetchall("""
+            SELECT 'discord', discord_status, COUNT(*) FROM notification_outbox
+            WHERE dedupe_key >= ? AND dedupe_key < ? GROUP BY discord_status
+            UNION ALL
+            SELECT 'telegram', telegram_status, COUNT(*) FROM notification_outbox
+            WHERE dedupe_key >= ? AND dedupe_key < ? GROUP BY telegram_status
+        """, self._group_range(prefix) * 2)
+        stats = {}
+        for platform, status, count in rows:
+            stats.setdefault(platform, {})[status] = count
+        return stats
+
+    async def cancel_group(self, prefix):
+        """Отменяет недоставленные каналы группы; возвращает число затронутых уведомлений"""
+        query = """
+            UPDATE notification_outbox
+            SET discord_status = CASE discord_status WHEN 'pending' THEN 'cancelled' ELSE discord_status END,
+                telegram_status = CASE telegram_status WHEN 'pending' THEN 'cancelled' ELSE telegram_status END
+            WHERE dedupe_key >= ? AND dedupe_key < ?
+              AND (discord_status = 'pending' OR telegram_status = 'pending')
+        """
+        return await self.db.run(lambda conn: conn.execute(query, self._group_range(prefix)).rowcount)
+
+    async def _poller(self):
+        # Пока Discord не готов, кэш пользователей пуст — доставлять рано
+        await bot.wait_until_ready()
+        while True:
             try:
-                await telegram_bot.send_message(
-                    chat_id=telegram_id,
-                    text=telegram_text,
-                    parse_mode="HTML"
-                )
+                rows = await self.db.fetchall("""
+                    SELECT * FROM notification_outbox
+                    WHERE (discord_status = 'pending' OR telegram_status = 'pending') AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT 100
+                """, (time.time(),))
+                for row in rows:
+                    if row["id"] not in self._in_flight:
+                        self._in_flight.add(row["id"])
+                        self.queue.put_nowait(row)
+                next_due = (await self.db.fetchone("""
+                    SELECT MIN(next_attempt_at) FROM notification_outbox
+                    WHERE discord_status = 'pending' OR telegram_status = 'pending'
+                """))[0]
             except Exception as e:
-                logging.error(f"Ошибка отправки сообщения в Telegram: {e}")
+                logging.error(f"Ошибка выборки очереди уведомлений: {e}")
+                next_due = None
+            timeout = 30 if next_due is None else min(max(next_due - time.time(), 1), 30)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
                 pass
+            self._wakeup.clear()
 
-    except Exception as e:
-        logging.error(f"Ошибка отправки уведомления для {discord_id}: {e}")
+    async def _worker(self):
+        while True:
+            row = await self.queue.get()
+            try:
+                await self._deliver(row)
+            except Exception as e:
+                logging.error(f"Ошибка доставки уведомления {row['id']}: {e}")
+            finally:
+                self._in_flight.discard(row["id"])
+                self.queue.task_done()
+
+    async def _deliver(self, row):
+        # Строка могла быть отменена, пока ждала в очереди воркеров
+        row = await self.db.fetchone("SELECT * FROM notification_outbox WHERE id = ?", (row["id"],))
+        if row is None or "pending" not in (row["discord_status"], row["telegram_status"]):
+            return
+        embed = discord.Embed.from_dict(json.loads(row["embed"])) if row["embed"] else None
+        discord_status, telegram_status = row["discord_status"], row["telegram_status"]
+        error = None
+
+        if discord_status == "pending":
+            user = bot.get_user(int(row["discord_id"]))
+            if user is None:
+                discord_status = "skipped"  # пользователь не найден среди участников серверов бота
+            else:
+                outcome = await dm_dispatcher.send(user, content=row["text"], embed=embed)
+                if outcome == "failed":
+                    error = "Discord: ошибка отправки"
+                else:
+                    discord_status = outcome
+
+        if telegram_status == "pending":
+            telegram_id = await get_telegram_id(row["discord_id"])
+            telegram_text = telegram_text_for(row["text"], embed)
+            if not telegram_id or not telegram_text:
+                telegram_status = "skipped"
+            else:
+                outcome = await telegram_sender.send(telegram_id, telegram_text)
+                if outcome == "failed":
+                    error = "Telegram: ошибка отправки"
+                else:
+                    telegram_status = outcome
+
+        attempts = row["attempts"] + 1
+        if "pending" in (discord_status, telegram_status):
+            if attempts >= self.max_attempts:
+                logging.error(f"Уведомление {row['id']} не доставлено за {attempts} попыток: {error}")
+                discord_status = "failed" if discord_status == "pending" else discord_status
+                telegram_status = "failed" if telegram_status == "pending" else telegram_status
+                self.failed += 1
+        else:
+            self.delivered += 1
+        next_attempt_at = time.time() + min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        await self.db.execute("""
+            UPDATE notification_outbox
+            SET discord_status = CASE discord_status WHEN 'cancelled' THEN discord_status ELSE ? END,
+                telegram_status = CASE telegram_status WHEN 'cancelled' THEN telegram_status ELSE ? END,
+                attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+        """, (discord_status, telegram_status, attempts, next_attempt_at, error, row["id"]))
+
+outbox = NotificationOutbox(workers=config.get("OUTBOX_WORKERS", 10))
 
 # Добавляем запуск Telegram бота в основной цикл
 async def main():
@@ -1606,41 +2856,53 @@ async def main():
         
         # Запускаем Discord бота
         discord_task = asyncio.create_task(bot.start(DISCORD_TOKEN))
+
+        # Запускаем воркеры фоновой рассылки ЛС и очереди уведомлений
+        dm_dispatcher.start()
+        telegram_sender.start()
+        outbox.start()
+        for writer in log_writers:
+            writer.start()
+
+        # Следим за изменениями config.json (мапа пересылки)
+        config_watch_task = asyncio.create_task(watch_config_changes())
         
         # Ждем завершения обоих задач
         await asyncio.gather(telegram_task, discord_task)
+        config_watch_task.cancel()
     except Exception as e:
         logging.error(f"Ошибка при запуске ботов: {e}")
         raise
+    finally:
+        # Сначала останавливаем всё, что обращается к базе и отправляет сообщения, затем закрываем базу
+        await outbox.stop()
+        await dm_dispatcher.stop()
+        await telegram_sender.stop()
+        await telegram_bot.session.close()
+        db.close()
+        log_listener.stop()  # дописываем оставшиеся в очереди записи
 
 @bot.command(name="reset_all_balances")
 @commands.has_permissions(administrator=True)
-async def reset_all_balances(ctx):
-    """Обнуляет балансы всех пользователей"""
+async def reset_all_balances(ctx, role: typing.Optional[discord.Role] = None, sign: str = "all"):
+    """Обнуляет балансы всех пользователей (или участников роли; sign: all / positive / negative)"""
+    sign = {"+": "positive", "-": "negative"}.get(sign, sign)
+    if sign not in ("all", "positive", "negative"):
+        await ctx.send("⚠️ Использование: `!reset_all_balances [@роль] [all|positive|negative]`")
+        return
     try:
-        # Получаем всех пользователей с ненулевым балансом
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT member_id, balance FROM balances WHERE balance != 0")
-            users = c.fetchall()
-            
-            if not users:
-                await ctx.send("ℹ️ Нет пользователей с ненулевым балансом.")
-                return
-                
-            # Обнуляем балансы
-            for user_id, balance in users:
-                balance_manager.withdraw(
-                    user_id, 
-                    balance, 
-                    nickname=ctx.guild.get_member(int(user_id)).display_name if ctx.guild.get_member(int(user_id)) else str(user_id),
-                    by=ctx.author.id,
-                    note="Mass balance reset"
-                )
-            
-            await ctx.send(f"✅ Обнулены балансы {len(users)} пользователей.")
-            logging.info(f"Массовое обнуление балансов выполнено администратором {ctx.author}")
-            
+        member_ids = [member.id for member in role.members] if role else None
+        count, total = await balance_manager.reset_balances(member_ids, sign, by=ctx.author.id, note="Mass balance reset")
+
+        if not count:
+            await ctx.send("ℹ️ Нет пользователей с ненулевым балансом.")
+            return
+
+        scope = f" с ролью {role.mention}" if role else ""
+        await ctx.send(f"✅ Обнулены балансы {count} пользователей{scope}. Суммарно списано: {total:,} серебра.")
+        logging.info(f"Массовое обнуление балансов ({sign}, роль: {role}) выполнено администратором {ctx.author}: "
+                     f"{count} пользователей, сумма {total}")
+
     except Exception as e:
         error_msg = f"❌ Ошибка при обнулении балансов: {str(e)}"
         await ctx.send(error_msg)
@@ -1651,56 +2913,51 @@ async def handle_telegram_message(message: types.Message):
     """Обработчик всех сообщений из Telegram"""
     try:
         # Получаем Discord ID пользователя по Telegram ID
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT discord_id FROM telegram_links WHERE telegram_id = ?", (str(message.from_user.id),))
-            result = c.fetchone()
+        discord_id = telegram_links.discord_of(message.from_user.id)
+        
+        if not discord_id:
+            return  # Если пользователь не привязан, игнорируем сообщение
+        
+        # Получаем объект пользователя Discord
+        guild = bot.guilds[0]  # Получаем первый сервер
+        discord_user = guild.get_member(int(discord_id))
+        
+        if not discord_user:
+            return
             
-            if not result:
-                return  # Если пользователь не привязан, игнорируем сообщение
-                
-            discord_id = result[0]
+        # Получаем канал для логов ЛС
+        log_channel = guild.get_channel(DM_LOG_CHANNEL_ID)
+        if not log_channel:
+            return
             
-            # Получаем объект пользователя Discord
-            guild = bot.guilds[0]  # Получаем первый сервер
-            discord_user = guild.get_member(int(discord_id))
+        # Создаем embed для сообщения
+        embed = discord.Embed(
+            title="📩 Новое сообщение из Telegram",
+            description=message.text or "*Нет текста*",
+            color=discord.Color.blue(),
+            timestamp=message.date
+        )
+        embed.set_author(
+            name=f"{discord_user.display_name} (Telegram: @{message.from_user.username})",
+            icon_url=discord_user.avatar.url if discord_user.avatar else None
+        )
+        
+        # Если есть фото
+        if message.photo:
+            photo = message.photo[-1]  # Берем самое большое фото
+            embed.set_image(url=photo.file_id)
             
-            if not discord_user:
-                return
-                
-            # Получаем канал для логов ЛС
-            log_channel = guild.get_channel(DM_LOG_CHANNEL_ID)
-            if not log_channel:
-                return
-                
-            # Создаем embed для сообщения
-            embed = discord.Embed(
-                title="📩 Новое сообщение из Telegram",
-                description=message.text or "*Нет текста*",
-                color=discord.Color.blue(),
-                timestamp=message.date
-            )
-            embed.set_author(
-                name=f"{discord_user.display_name} (Telegram: @{message.from_user.username})",
-                icon_url=discord_user.avatar.url if discord_user.avatar else None
+        # Если есть документ
+        if message.document:
+            embed.add_field(
+                name="Документ",
+                value=f"📎 {message.document.file_name}",
+                inline=False
             )
             
-            # Если есть фото
-            if message.photo:
-                photo = message.photo[-1]  # Берем самое большое фото
-                embed.set_image(url=photo.file_id)
-                
-            # Если есть документ
-            if message.document:
-                embed.add_field(
-                    name="Документ",
-                    value=f"📎 {message.document.file_name}",
-                    inline=False
-                )
-                
-            # Отправляем в канал логов
-            await log_channel.send(embed=embed)
-            
+        # Отправляем в канал логов
+        await log_channel.send(embed=embed)
+        
     except Exception as e:
         logging.error(f"Ошибка при обработке сообщения из Telegram: {e}")
 
@@ -0,0 +1,270 @@
+import logging  # Импорт модуля логирования
+import sys
+
+from db import Database
+
+# ==============================
+# Версионированные миграции схемы (номер версии хранится в PRAGMA user_version)
+# ==============================
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _m1_base_schema(conn):
+    """Базовая схема — то, что раньше создавал init_db"""
+    # Таблица баланса
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS balances (
+            member_id TEXT PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0,
+            nickname TEXT
+        )
+    """)
+    # Таблица транзакций
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            member_id TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            note TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Таблица штрафов
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT,
+            is_closed INTEGER DEFAULT 0,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Таблица сборов
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS parties (
+            party_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            creator_id TEXT NOT NULL,
+            info TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Таблица участников сборов
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS party_members (
+            party_id INTEGER NOT NULL,
+            member_id TEXT NOT NULL,
+            PRIMARY KEY (party_id, member_id),
+            FOREIGN KEY(party_id) REFERENCES parties(party_id) ON DELETE CASCADE
+        )
+    """)
+    # Таблица посещаемости
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            member_id TEXT,
+            check_in_date TEXT
+        )
+    """)
+    # Таблица для хранения связей Discord-Telegram
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_links (
+            discord_id TEXT PRIMARY KEY,
+            telegram_id TEXT NOT NULL,
+            telegram_username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Таблица для временных кодов привязки
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_link_codes (
+            code TEXT PRIMARY KEY,
+            discord_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _m2_fix_drift(conn):
+    """Приводит к базовой схеме таблицы, созданные старыми версиями init_db"""
+    # Старый init_db создавал party_members с суррогатным id и без уникальности пары
+    if "id" in _columns(conn, "party_members"):
+        conn.execute("ALTER TABLE party_members RENAME TO party_members_old")
+        _m1_base_schema(conn)
+        # Старый код не проверял существование сбора и работал без внешних ключей — сироты не переносим
+        copied = conn.execute("""
+            INSERT OR IGNORE INTO party_members (party_id, member_id)
+            SELECT party_id, member_id FROM party_members_old
+            WHERE party_id IN (SELECT party_id FROM parties) ORDER BY id
+        """).rowcount
+        total = conn.execute("SELECT COUNT(*) FROM party_members_old").fetchone()[0]
+        if copied < total:
+            logging.warning(f"Миграция party_members: отброшено {total - copied} строк (несуществующие сборы или дубликаты)")
+        conn.execute("DROP TABLE party_members_old")
+
+    # fines.timestamp был только в рабочей базе; ADD COLUMN не допускает DEFAULT CURRENT_TIMESTAMP
+    if "timestamp" not in _columns(conn, "fines"):
+        conn.execute("ALTER TABLE fines RENAME TO fines_old")
+        _m1_base_schema(conn)
+        conn.execute("""
+            INSERT INTO fines (id, user_id, amount, reason, is_closed, timestamp)
+            SELECT id, user_id, amount, reason, is_closed, NULL FROM fines_old
+        """)
+        conn.execute("DROP TABLE fines_old")
+
+
+def _m3_hot_path_indexes(conn):
+    """Покрывающие индексы для запросов, которые выполняются постоянно"""
+    # История баланса: WHERE member_id = ? ORDER BY timestamp (rowid в индексе разрешает равные timestamp)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_member_ts ON transactions (member_id, timestamp)")
+    # Сумма открытых штрафов: WHERE user_id = ? AND is_closed = 0 -> SUM(amount) только по индексу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fines_user_open ON fines (user_id, is_closed, amount)")
+    # Входящие сообщения Telegram: поиск discord_id по telegram_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telegram_links_tg ON telegram_links (telegram_id, discord_id)")
+    # Удаление старых кодов привязки пользователя
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_link_codes_discord ON telegram_link_codes (discord_id)")
+    # party_members(party_id) обслуживается первичным ключом (party_id, member_id)
+
+
+def _m4_notification_outbox(conn):
+    """Очередь уведомлений: переживает перезапуск, статус доставки по каждому каналу отдельно"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE,
+            discord_id TEXT NOT NULL,
+            text TEXT,
+            embed TEXT,
+            discord_status TEXT NOT NULL DEFAULT 'pending',
+            telegram_status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Частичный индекс: воркеры выбирают только недоставленное
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox (next_attempt_at)
+        WHERE discord_status = 'pending' OR telegram_status = 'pending'
+    """)
+
+
+def _m5_attendance_unique(conn):
+    """Одна отметка посещаемости на участника в день"""
+    conn.execute("""
+        DELETE FROM attendance WHERE id NOT IN (
+            SELECT MIN(id) FROM attendance GROUP BY member_id, check_in_date
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_member_date ON attendance (member_id, check_in_date)")
+
+
+def _m6_open_fines_total(conn):
+    """Текущая сумма открытых штрафов хранится рядом с балансом и меняется вместе с ним"""
+    if "open_fines" not in _columns(conn, "balances"):
+        conn.execute("ALTER TABLE balances ADD COLUMN open_fines INTEGER NOT NULL DEFAULT 0")
+    # debited = 1 — сумма штрафа уже списана с баланса, и при закрытии её нужно вернуть
+    if "debited" not in _columns(conn, "fines"):
+        conn.execute("ALTER TABLE fines ADD COLUMN debited INTEGER NOT NULL DEFAULT 0")
+    # Старый sync_fines_with_balance ставил баланс в -сумму открытых штрафов и создавал строку balances.
+    # Штрафы участников без такой строки (внесённые мимо бота) в баланс не попадали — их не списываем и не возвращаем
+    conn.execute("""
+        UPDATE fines SET debited = 1
+        WHERE is_closed = 0 AND user_id IN (SELECT member_id FROM balances)
+    """)
+    conn.execute("""
+        INSERT INTO balances (member_id, open_fines)
+        SELECT user_id, SUM(amount) FROM fines WHERE is_closed = 0 GROUP BY user_id
+        ON CONFLICT(member_id) DO UPDATE SET open_fines = excluded.open_fines
+    """)
+
+
+MIGRATIONS = [
+    (1, "базовая схема", _m1_base_schema),
+    (2, "исправление расхождений схемы", _m2_fix_drift),
+    (3, "индексы горячих запросов", _m3_hot_path_indexes),
+    (4, "очередь уведомлений", _m4_notification_outbox),
+    (5, "уникальные отметки посещаемости", _m5_attendance_unique),
+    (6, "сумма открытых штрафов в балансе", _m6_open_fines_total),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn):
+    """Применяет недостающие миграции; каждая выполняется в отдельной транзакции"""
+    if conn.in_transaction:
+        conn.commit()
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+
+# ==============================
+# Проверка планов горячих запросов: python migrations.py [путь к базе]
+# ==============================
+HOT_QUERIES = {
+    "баланс участника": ("SELECT balance FROM balances WHERE member_id = ?", ("0",)),
+    "история баланса": ("SELECT id, type, amount, note, timestamp FROM transactions "
+                        "WHERE member_id = ? ORDER BY timestamp DESC, id DESC LIMIT 11", ("0",)),
+    "история баланса (след. страница)": ("SELECT id, type, amount, note, timestamp FROM transactions "
+                                         "WHERE member_id = ? AND (timestamp, id) < (?, ?) "
+                                         "ORDER BY timestamp DESC, id DESC LIMIT 11", ("0", "", 0)),
+    "сумма открытых штрафов": ("SELECT open_fines FROM balances WHERE member_id = ?", ("0",)),
+    "закрытие штрафа": ("UPDATE fines SET is_closed = 1 WHERE id = ? AND is_closed = 0", (0,)),
+    "участники сбора": ("SELECT member_id FROM party_members WHERE party_id = ?", (0,)),
+    "вход в сбор": ("INSERT OR IGNORE INTO party_members (party_id, member_id) "
+                    "SELECT party_id, ? FROM parties WHERE party_id = ?", ("0", 0)),
+    "Telegram по Discord ID": ("SELECT telegram_id FROM telegram_links WHERE discord_id = ?", ("0",)),
+    "очередь уведомлений": ("SELECT id FROM notification_outbox "
+                            "WHERE (discord_status = 'pending' OR telegram_status = 'pending') "
+                            "AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 100", (0,)),
+    "отметки участника": ("SELECT check_in_date FROM attendance WHERE member_id = ?", ("0",)),
+    "Discord по Telegram ID": ("SELECT discord_id FROM telegram_links WHERE telegram_id = ?", ("0",)),
+}
+
+
+def explain_hot_queries(conn):
+    """Возвращает {название: (строки плана, использует ли индекс)}"""
+    report = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        # Полный проход по таблице выглядит как "SCAN <table>" без "USING ... INDEX"
+        uses_index = all(not line.startswith("SCAN") or "INDEX" in line for line in plan)
+        report[name] = (plan, uses_index)
+    return report
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "../bot.db"
+    # Те же PRAGMA (foreign_keys, WAL), что и у бота, — иначе проверка пропустит ошибки миграций
+    database = Database(db_path)
+    try:
+        for version, description in database.run_blocking(migrate):
+            print(f"Применена миграция {version}: {description}")
+        print(f"Версия схемы: {database.run_blocking(lambda conn: conn.execute('PRAGMA user_version').fetchone()[0])}\n")
+        failed = 0
+        for name, (plan, uses_index) in database.run_blocking(explain_hot_queries).items():
+            print(f"{'✅' if uses_index else '❌'} {name}")
+            for line in plan:
+                print(f"    {line}")
+            failed += not uses_index
+    finally:
+        database.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,38 @@
+import asyncio  # Импорт модуля для работы с асинхронностью
+import time
+
+
+class TokenBucket:
+    """Асинхронный token bucket: в среднем rate операций в секунду, не больше capacity подряд.
+
+    pause() останавливает выдачу токенов целиком — так соблюдается retry-after от сервера.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:  # ожидающие получают токены по очереди
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Запрещает выдачу токенов на seconds секунд (например, после HTTP 429)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
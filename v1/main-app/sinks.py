@@ -0,0 +1,186 @@
+import csv
+import json
+import os
+import sqlite3
+
+# ==============================
+# Приёмники выгрузки для sync.py
+# ==============================
+# Строки приходят пачками (fetchmany), поэтому память не зависит от размера таблицы.
+# append-таблицы дописываются после водяного знака, snapshot-таблицы перезаписываются целиком
+# (Google Sheets вместо этого отправляет разницу — см. SheetsSink в sync.py).
+
+
+class Sink:
+    """Базовый приёмник: ведёт прогресс по листам и водяные знаки append-таблиц"""
+
+    name = None
+
+    def __init__(self):
+        self.progress = {}  # имя листа -> {'rows': выгружено строк, 'done': завершено}
+
+    def track(self, sheet_name, batches):
+        """Пропускает пачки через счётчик прогресса"""
+        progress = self.progress[sheet_name] = {'rows': 0, 'done': False}
+        for batch in batches:
+            yield batch
+            progress['rows'] += len(batch)
+        progress['done'] = True
+
+    def prepare(self, sheet, sheet_state):
+        """Вызывается до чтения таблицы: сбрасывает водяной знак, если приёмник потерял выгруженные строки"""
+        if sheet['mode'] == 'append' and sheet_state.get('watermark') is not None and not self.has_target(sheet):
+            sheet_state.pop('watermark', None)
+
+    def has_target(self, sheet):
+        return True
+
+    def sync(self, sheet, columns, sheet_state, batches):
+        """Выгружает таблицу; возвращает число записанных строк"""
+        batches = self.track(sheet['sheet_name'], batches)
+        if sheet['mode'] == 'append':
+            return self.sync_append(sheet, columns, sheet_state, batches)
+        return self.sync_snapshot(sheet, columns, sheet_state, batches)
+
+    def sync_append(self, sheet, columns, sheet_state, batches):
+        raise NotImplementedError
+
+    def sync_snapshot(self, sheet, columns, sheet_state, batches):
+        raise NotImplementedError
+
+
+class FileSink(Sink):
+    """Общая часть CSV и JSON lines: один файл на таблицу в каталоге directory"""
+
+    extension = None
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.name = f"{self.extension}:{directory}"
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, sheet):
+        return os.path.join(self.directory, f"{sheet['table']}.{self.extension}")
+
+    def has_target(self, sheet):
+        return os.path.exists(self.path(sheet))
+
+    def write_header(self, f, columns):
+        pass
+
+    def write_rows(self, f, columns, rows):
+        raise NotImplementedError
+
+    def sync_append(self, sheet, columns, sheet_state, batches):
+        path = self.path(sheet)
+        count = 0
+        if sheet_state.get('watermark') is None:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                self.write_header(f, columns)
+            sheet_state['size'] = os.path.getsize(path)
+        # Отрезаем то, что успела дописать прерванная выгрузка, — её строки придут снова
+        with open(path, 'r+b') as f:
+            f.truncate(min(sheet_state.get('size', os.path.getsize(path)), os.path.getsize(path)))
+        with open(path, 'a', encoding='utf-8', newline='') as f:
+            for batch in batches:
+                self.write_rows(f, columns, batch)
+                count += len(batch)
+                sheet_state['watermark'] = batch[-1][0]
+        sheet_state.setdefault('watermark', 0)
+        sheet_state['size'] = os.path.getsize(path)
+        return count
+
+    def sync_snapshot(self, sheet, columns, sheet_state, batches):
+        path = self.path(sheet)
+        count = 0
+        # Новый файл пишется рядом и подменяет старый целиком
+        with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            self.write_header(f, columns)
+            for batch in batches:
+                self.write_rows(f, columns, batch)
+                count += len(batch)
+        os.replace(path + '.tmp', path)
+        return count
+
+
+class CsvSink(FileSink):
+    extension = 'csv'
+
+    def write_header(self, f, columns):
+        csv.writer(f).writerow(columns)
+
+    def write_rows(self, f, columns, rows):
+        csv.writer(f).writerows(rows)
+
+
+class JsonLinesSink(FileSink):
+    extension = 'jsonl'
+
+    def write_rows(self, f, columns, rows):
+        f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+
+
+class SqliteSink(Sink):
+    """Копия таблиц в отдельном файле SQLite; каждая таблица выгружается одной транзакцией"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.name = f"sqlite:{path}"
+
+    def _connect(self):
+        # У каждого потока выгрузки своё соединение
+        return sqlite3.connect(self.path, timeout=30)
+
+    def has_target(self, sheet):
+        if not os.path.exists(self.path):
+            return False
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (sheet['table'],)).fetchone() is not None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _prepare(conn, sheet, columns):
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{sheet["table"]}" ({column_list})')
+        return f'INSERT INTO "{sheet["table"]}" ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+
+    def _write(self, sheet, columns, sheet_state, batches, clear):
+        count = 0
+        conn = self._connect()
+        try:
+            with conn:
+                insert = self._prepare(conn, sheet, columns)
+                if clear:
+                    conn.execute(f'DELETE FROM "{sheet["table"]}"')
+                for batch in batches:
+                    conn.executemany(insert, batch)
+                    count += len(batch)
+                    if sheet['mode'] == 'append':
+                        sheet_state['watermark'] = batch[-1][0]
+        finally:
+            conn.close()
+        return count
+
+    def sync_append(self, sheet, columns, sheet_state, batches):
+        clear = sheet_state.get('watermark') is None
+        count = self._write(sheet, columns, sheet_state, batches, clear)
+        sheet_state.setdefault('watermark', 0)
+        return count
+
+    def sync_snapshot(self, sheet, columns, sheet_state, batches):
+        return self._write(sheet, columns, sheet_state, batches, clear=True)
+
+
+LOCAL_SINKS = {'csv': CsvSink, 'jsonl': JsonLinesSink, 'sqlite': SqliteSink}
+
+
+def make_sink(spec):
+    """Создаёт приёмник по описанию вида "csv:каталог", "jsonl:каталог" или "sqlite:файл" """
+    kind, _, target = spec.partition(':')
+    if kind not in LOCAL_SINKS or not target:
+        raise ValueError(f"Неизвестный приёмник '{spec}' (ожидается csv:<каталог>, jsonl:<каталог> или sqlite:<файл>)")
+    return LOCAL_SINKS[kind](target)
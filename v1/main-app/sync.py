@@ -1,14 +1,29 @@
+import argparse
+import json
+import os
 import sqlite3
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 import schedule
 import time
 
+from sinks import Sink, make_sink  # Локальные приёмники: CSV, JSON lines, SQLite
+
+try:
+    import gspread
+    from gspread.utils import rowcol_to_a1
+    from oauth2client.service_account import ServiceAccountCredentials
+except ImportError:  # для выгрузки только в локальные приёмники Google-библиотеки не нужны
+    gspread = None
+
 # === НАСТРОЙКИ ===
 DB_NAME = '../bot.db'
 SPREADSHEET_NAME = 'hell'  # Название Google Sheets
 CREDENTIALS_FILE = '../root-monolith-453308-b0-a09a185173f2.json'  # JSON файл из Google Cloud
+STATE_FILE = '../sync_state.json'  # Что уже выгружено в каждый лист (водяные знаки и снимки)
+SYNC_INTERVAL = 60  # Пауза между проверками изменений, секунд
+UPLOAD_WORKERS = 3  # Сколько листов выгружается одновременно
+BATCH_SIZE = 1000  # Строк в одной пачке fetchmany
 
 # === НАСТРОЙКА ДОСТУПА К GOOGLE SHEETS ===
 scope = ["https://spreadsheets.google.com/feeds",
@@ -16,86 +31,323 @@ scope = ["https://spreadsheets.google.com/feeds",
          "https://www.googleapis.com/auth/drive.file",
          "https://www.googleapis.com/auth/drive"]
 
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-client = gspread.authorize(creds)
+# === ПОДКЛЮЧАЕМСЯ К БАЗЕ ДАННЫХ ===
+# Только чтение: синхронизация никогда не блокирует запись бота (база в режиме WAL)
+def connect_readonly():
+    return sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True)
 
-# === ОТКРЫВАЕМ ТАБЛИЦУ ===
-spreadsheet = client.open(SPREADSHEET_NAME)
 
-# === ПОДКЛЮЧАЕМСЯ К БАЗЕ ДАННЫХ ===
-conn = sqlite3.connect(DB_NAME)
-cursor = conn.cursor()
+conn = connect_readonly()  # для проверки изменений; выгрузки открывают свои соединения
 
-# === ФУНКЦИЯ ДЛЯ ОБНОВЛЕНИЯ ЛИСТОВ ===
-def sync_table(sheet_name, query, headers):
-    try:
-        worksheet = spreadsheet.worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="100", cols="20")
+# === ЛИСТЫ ===
+# append — таблица только растёт: выгружаются строки с id больше водяного знака.
+# snapshot — строки меняются и удаляются: выгружается разница с последним выгруженным снимком (ключ — первые key_columns колонок).
+# signature — дешёвый запрос-отпечаток: пока он не изменился, лист не трогаем.
+# signature = None — надёжного отпечатка нет, лист сверяется со снимком при каждом изменении базы.
+SHEETS = [
+    {
+        'sheet_name': 'Balances', 'table': 'balances',
+        'mode': 'snapshot', 'key_columns': 1,
+        # Перевод или смена ника не меняют COUNT/TOTAL/MAX(rowid), но каждое изменение баланса пишет запись в журнал
+        'signature': 'SELECT COUNT(*), TOTAL(balance), MAX(rowid), (SELECT MAX(id) FROM transactions) FROM balances',
+        'query': 'SELECT member_id, balance, nickname FROM balances',
+        'headers': ['member_id', 'balance', 'nickname'],
+    },
+    {
+        'sheet_name': 'Transactions', 'table': 'transactions',
+        'mode': 'append',
+        'signature': 'SELECT MAX(id) FROM transactions',
+        'query': 'SELECT id, type, member_id, amount, note, timestamp FROM transactions WHERE id > ? ORDER BY id',
+        'headers': ['id', 'type', 'member_id', 'amount', 'note', 'timestamp'],
+    },
+    {
+        'sheet_name': 'Parties', 'table': 'parties',
+        'mode': 'snapshot', 'key_columns': 1,
+        'signature': 'SELECT COUNT(*), MAX(party_id) FROM parties',
+        'query': 'SELECT party_id, creator_id, info, created_at FROM parties',
+        'headers': ['party_id', 'creator_id', 'info', 'created_at'],
+    },
+    {
+        'sheet_name': 'Party Members', 'table': 'party_members',
+        'mode': 'snapshot', 'key_columns': 2,
+        # Выход и повторный вход в тот же сбор могут оставить любые агрегаты прежними
+        'signature': None,
+        'query': 'SELECT party_id, member_id FROM party_members',
+        'headers': ['party_id', 'member_id'],
+    },
+    {
+        'sheet_name': 'Attendance', 'table': 'attendance',
+        'mode': 'append',
+        'signature': 'SELECT MAX(id) FROM attendance',
+        'query': 'SELECT id, member_id, check_in_date FROM attendance WHERE id > ? ORDER BY id',
+        'headers': ['id', 'member_id', 'check_in_date'],
+    },
+    {
+        # Штрафы закрываются (is_closed меняется), поэтому это снимок, а не добавление по id
+        'sheet_name': 'fines', 'table': 'fines',
+        'mode': 'snapshot', 'key_columns': 1,
+        'signature': 'SELECT COUNT(*), MAX(id), TOTAL(is_closed), TOTAL(amount) FROM fines',
+        'query': 'SELECT id, user_id, amount, reason, is_closed, timestamp FROM fines',
+        'headers': ['id', 'id', 'AMOUNT', 'REASON', 'IS_CLOSED', 'timestamp'],
+    },
+]
 
-    try:
-        cursor.execute(query)  # Используем глобальный курсор
-        records = cursor.fetchall()
 
-        if not records:
-            print(f"⚠️ Нет данных для '{sheet_name}'")
+# === СОСТОЯНИЕ СИНХРОНИЗАЦИИ ===
+def load_state():
+    """Состояние по приёмникам: {имя приёмника: {имя листа: {...}}}"""
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        # Раньше состояние хранилось только для Google Sheets, без уровня приёмника
+        if any(sheet['sheet_name'] in loaded for sheet in SHEETS):
+            loaded = {'sheets': loaded}
+        return loaded
+    return {}
+
+
+def save_state(state):
+    # Пишем во временный файл и подменяем, чтобы сбой не оставил половину состояния
+    tmp_path = STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, STATE_FILE)
+
+
+state = load_state()
+
+
+# === ФУНКЦИИ ДЛЯ ОБНОВЛЕНИЯ ЛИСТОВ ===
+def rewrite_sheet(worksheet, headers, rows):
+    """Полная перезапись листа — только при первой синхронизации или потере состояния"""
+    worksheet.clear()
+    worksheet.update('A1', [headers] + rows)
+
+
+def stream_rows(sheet, sheet_state):
+    """Открывает своё соединение только для чтения и отдаёт (колонки, пачки строк по BATCH_SIZE)"""
+    reader = connect_readonly()
+    params = (sheet_state.get('watermark') or 0,) if sheet['mode'] == 'append' else ()
+    cursor = reader.execute(sheet['query'], params)
+    columns = [description[0] for description in cursor.description]
+
+    def batches():
+        try:
+            while True:
+                batch = cursor.fetchmany(BATCH_SIZE)
+                if not batch:
+                    return
+                yield batch
+        finally:
+            reader.close()
+
+    return columns, batches()
+
+
+def _row_ranges(dirty, width):
+    """Группирует изменённые строки листа в непрерывные диапазоны для одного batch_update"""
+    ranges = []
+    for index in sorted(dirty):
+        if ranges and ranges[-1]['end'] == index - 1:
+            ranges[-1]['end'] = index
+            ranges[-1]['values'].append(dirty[index])
+        else:
+            ranges.append({'start': index, 'end': index, 'values': [dirty[index]]})
+    # Строка листа = позиция в снимке + 2 (первая строка — заголовки)
+    return [{'range': f"{rowcol_to_a1(r['start'] + 2, 1)}:{rowcol_to_a1(r['end'] + 2, width)}", 'values': r['values']}
+            for r in ranges]
+
+
+def diff_snapshot(worksheet, sheet, sheet_state, rows):
+    """Сравнивает таблицу с последним выгруженным снимком и отправляет только изменённые строки"""
+    key_columns = sheet['key_columns']
+    width = len(sheet['headers'])
+    current = {'\t'.join(values[:key_columns]): values for values in rows}
+
+    if 'order' not in sheet_state:
+        order = list(current)
+        rewrite_sheet(worksheet, sheet['headers'], [current[key] for key in order])
+        sheet_state.update(order=order, rows=current)
+        return len(order)
+
+    order = sheet_state['order']  # ключ строки листа по позиции
+    pushed = sheet_state['rows']  # ключ -> выгруженные значения
+    position = {key: index for index, key in enumerate(order)}
+    dirty = {}  # позиция -> новые значения строки
+
+    # Удалённая строка заменяется последней, последняя очищается — остальные строки не сдвигаются
+    for key in [key for key in order if key not in current]:
+        index, last = position.pop(key), order.pop()
+        del pushed[key]
+        if last != key:
+            order[index] = last
+            position[last] = index
+            dirty[index] = pushed[last]
+        dirty[len(order)] = [''] * width
 
-        data = [headers] + [list(map(str, row)) for row in records]
+    for key, values in current.items():
+        if key not in position:
+            position[key] = len(order)
+            order.append(key)
+        elif pushed[key] == values:
+            continue
+        pushed[key] = values
+        dirty[position[key]] = values
 
-        worksheet.clear()
-        worksheet.update('A1', data)
-        print(f"[{datetime.now()}] ✅ Таблица '{sheet_name}' синхронизирована!")
+    if dirty:
+        needed_rows = len(order) + 2
+        if worksheet.row_count < needed_rows:
+            worksheet.add_rows(needed_rows - worksheet.row_count + 100)
+        worksheet.batch_update(_row_ranges(dirty, width), value_input_option='RAW')
+    return len(dirty)
 
-    except Exception as e:
-        print(f"❌ Ошибка при синхронизации '{sheet_name}': {e}")
+
+class SheetsSink(Sink):
+    """Google Sheets: append-листы дописываются пачками, snapshot-листы получают только разницу"""
+
+    name = 'sheets'
+
+    def __init__(self):
+        super().__init__()
+        if gspread is None:
+            raise RuntimeError("Для выгрузки в Google Sheets нужны пакеты gspread и oauth2client")
+        creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
+        client = gspread.authorize(creds)
+
+        # === ОТКРЫВАЕМ ТАБЛИЦУ ===
+        self.spreadsheet = client.open(SPREADSHEET_NAME)
+
+    def get_worksheet(self, sheet_name):
+        try:
+            return self.spreadsheet.worksheet(sheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            return self.spreadsheet.add_worksheet(title=sheet_name, rows="100", cols="20")
+
+    def sync_append(self, sheet, columns, sheet_state, batches):
+        """Дописывает строки, появившиеся после водяного знака (последнего выгруженного id)"""
+        worksheet = self.get_worksheet(sheet['sheet_name'])
+        if sheet_state.get('watermark') is None:
+            rewrite_sheet(worksheet, sheet['headers'], [])
+        count = 0
+        for batch in batches:
+            worksheet.append_rows([list(map(str, row)) for row in batch], value_input_option='RAW')
+            count += len(batch)
+            sheet_state['watermark'] = batch[-1][0]
+        sheet_state.setdefault('watermark', 0)
+        return count
+
+    def sync_snapshot(self, sheet, columns, sheet_state, batches):
+        # Для сравнения со снимком нужна вся таблица — она и так хранится в состоянии
+        rows = [list(map(str, row)) for batch in batches for row in batch]
+        return diff_snapshot(self.get_worksheet(sheet['sheet_name']), sheet, sheet_state, rows)
+
+
+def run_sync(sink, sheet, sheet_state):
+    """Выгружает одну таблицу в один приёмник (выполняется в пуле потоков)"""
+    sink.prepare(sheet, sheet_state)  # до запроса: он читает строки после водяного знака
+    columns, batches = stream_rows(sheet, sheet_state)
+    return sink.sync(sheet, columns, sheet_state, batches)
+
+
+# === ОПРЕДЕЛЕНИЕ ИЗМЕНЕНИЙ ===
+last_data_version = None
+
+
+def database_changed():
+    """PRAGMA data_version меняется, когда другое соединение (бот) что-то записало"""
+    global last_data_version
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    changed = data_version != last_data_version
+    last_data_version = data_version
+    return changed
+
+
+reported_missing = set()
+
+
+def table_signatures():
+    """Отпечатки всех таблиц; отсутствующие таблицы пропускаются"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    signatures = {}
+    for sheet in SHEETS:
+        if sheet['table'] not in tables:
+            if sheet['table'] not in reported_missing:
+                print(f"⚠️ Таблицы '{sheet['table']}' нет в базе — лист '{sheet['sheet_name']}' пропущен")
+                reported_missing.add(sheet['table'])
+            continue
+        signatures[sheet['sheet_name']] = list(conn.execute(sheet['signature']).fetchone()) if sheet['signature'] else None
+    return signatures
+
+
+def print_progress(tasks):
+    for (sink, sheet_name), (_, future) in tasks.items():
+        progress = sink.progress.get(sheet_name)
+        if progress and not future.done():
+            print(f"   ⏳ {sink.name} / {sheet_name}: {progress['rows']} строк")
 
 
 # === СИНХРОНИЗАЦИЯ ТАБЛИЦ ===
-def job():
-    print(1)
-    print(f"[{datetime.now()}] 🔄 Запуск синхронизации...")
-    sync_table(
-        sheet_name='Balances',
-        query='SELECT member_id, balance, nickname FROM balances',
-        headers=['member_id', 'balance', 'nickname']
-    )
-    sync_table(
-        sheet_name='Transactions',
-        query='SELECT id, type, member_id, amount, note, timestamp FROM transactions',
-        headers=['id', 'type', 'member_id', 'amount', 'note', 'timestamp']
-    )
-    sync_table(
-        sheet_name='Parties',
-        query='SELECT party_id, creator_id, info, created_at FROM parties',
-        headers=['party_id', 'creator_id', 'info', 'created_at']
-    )
-    sync_table(
-        sheet_name='Party Members',
-        query='SELECT party_id, member_id FROM party_members',
-        headers=['party_id', 'member_id']
-    )
-    sync_table(
-        sheet_name='Attendance',
-        query='SELECT id, member_id, check_in_date FROM attendance',
-        headers=['id', 'member_id', 'check_in_date']
-    )
-    sync_table(
-        sheet_name='fines',
-        query='SELECT id, user_id, amount, reason, is_closed, timestamp FROM fines',
-        headers=['id', 'id', 'AMOUNT', 'REASON', 'IS_CLOSED', 'timestamp']
-    )
+def job(sinks):
+    global last_data_version
+    if not database_changed():
+        return  # бот ничего не записывал с прошлой проверки
+    signatures = table_signatures()
+
+    # Чтение и выгрузка — параллельно по парам (приёмник, лист), у каждой своё соединение только для чтения
+    tasks = {}
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        for sink in sinks:
+            sink_state = state.setdefault(sink.name, {})
+            for sheet in SHEETS:
+                if sheet['sheet_name'] not in signatures:
+                    continue  # таблицы нет в базе
+                signature = signatures[sheet['sheet_name']]
+                if signature is not None and sink_state.get(sheet['sheet_name'], {}).get('signature') == signature:
+                    continue
+                # Работаем с копией: при ошибке выгрузки сохранённое состояние остаётся прежним
+                sheet_state = json.loads(json.dumps(sink_state.get(sheet['sheet_name'], {})))
+                sheet_state['signature'] = signature
+                tasks[(sink, sheet['sheet_name'])] = (sheet_state, executor.submit(run_sync, sink, sheet, sheet_state))
+        if not tasks:
+            return
+        print(f"[{datetime.now()}] 🔄 Запуск синхронизации: "
+              f"{', '.join(f'{sink.name} / {sheet_name}' for sink, sheet_name in tasks)}")
+        while wait([future for _, future in tasks.values()], timeout=10).not_done:
+            print_progress(tasks)
+
+    for (sink, sheet_name), (sheet_state, future) in tasks.items():
+        try:
+            changed_rows = future.result()
+            state[sink.name][sheet_name] = sheet_state
+            print(f"[{datetime.now()}] ✅ {sink.name} / '{sheet_name}' синхронизирована (записано строк: {changed_rows})")
+        except Exception as e:
+            print(f"❌ Ошибка при синхронизации {sink.name} / '{sheet_name}': {e}")
+            last_data_version = None  # повторим на следующей проверке, даже если бот ничего не запишет
+    save_state(state)
     print(f"[{datetime.now()}] ✅ Синхронизация завершена!")
 
-# Запуск каждые 5 минут
-#schedule.every(5).minutes.do(job)
-job()
-print("🔄 Запущен скрипт синхронизации (обновление каждые 5 минут)...")
-print(f"[{datetime.now()}] ✅ Синхронизация завершена!")
-while True:
-    schedule.run_pending()
-    time.sleep(1)
 
-# === ЗАКРЫВАЕМ ПОДКЛЮЧЕНИЯ ===
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка таблиц бота в Google Sheets и локальные файлы")
+    parser.add_argument('--sink', action='append', dest='sinks', metavar='ПРИЁМНИК',
+                        help="sheets, csv:<каталог>, jsonl:<каталог> или sqlite:<файл> (можно несколько; по умолчанию sheets)")
+    parser.add_argument('--once', action='store_true', help="выполнить одну синхронизацию и выйти")
+    args = parser.parse_args()
+    sinks = [SheetsSink() if spec == 'sheets' else make_sink(spec) for spec in args.sinks or ['sheets']]
 
+    try:
+        job(sinks)
+        if args.once:
+            return
+        schedule.every(SYNC_INTERVAL).seconds.do(job, sinks)
+        print(f"🔄 Запущен скрипт синхронизации (проверка изменений каждые {SYNC_INTERVAL} с)...")
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
+    finally:
+        # === ЗАКРЫВАЕМ ПОДКЛЮЧЕНИЯ ===
+        conn.close()
 
 
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, flash
+from datetime import datetime
 import json
 import os
 import sqlite3
+import time
 
 app = Flask(__name__)
 import os
@@ -81,14 +83,184 @@ def messages_page():
     return render_template("messages.html", messages=messages)
 
 
+# ==============================
+# Просмотр логов: чтение с конца файла страницами и live-режим через SSE
+# ==============================
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_PAGE_SIZE = 100
+LOG_SCAN_LIMIT = 8 * 1024 * 1024  # сколько байт максимум просматривается за один запрос страницы
+
+
+def parse_log_line(line):
+    """Разбирает строку лога: JSON lines или старый текстовый формат "время - уровень - сообщение" """
+    line = line.strip()
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            pass
+        else:
+            # JSON-записи пишутся в UTC — показываем и сравниваем в локальном времени сервера, как старые
+            ts = _log_time(record.get("ts"))
+            record["ts"] = ts.isoformat(timespec="milliseconds") if ts else None
+            return record
+    parts = line.split(" - ", 2)
+    if len(parts) == 3 and parts[1] in LOG_LEVELS:
+        try:
+            ts = datetime.strptime(parts[0], "%Y-%m-%d %H:%M:%S,%f").astimezone().isoformat(timespec="milliseconds")
+            return {"ts": ts, "level": parts[1], "message": parts[2]}
+        except ValueError:
+            pass
+    return {"ts": None, "level": None, "message": line}  # продолжение traceback старого формата
+
+
+def _log_time(value):
+    """Время записи или фильтра с часовым поясом; время без пояса (старые записи, поля формы) — локальное"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).astimezone()
+    except (TypeError, ValueError):
+        return None
+
+
+def log_filters(args):
+    """Фильтры из параметров запроса: level, since, until (ISO-время), q (текст)"""
+    level = (args.get("level") or "").upper()
+    return {
+        "level": level if level in LOG_LEVELS else None,  # неизвестный уровень — без фильтра, а не ошибка 500
+        "since": _log_time(args.get("since")),
+        "until": _log_time(args.get("until")),
+        "q": (args.get("q") or "").lower() or None,
+    }
+
+
+def log_matches(record, filters):
+    level = record.get("level")
+    if filters["level"] and LOG_LEVELS.index(level if level in LOG_LEVELS else "DEBUG") < LOG_LEVELS.index(filters["level"]):
+        return False
+    ts = _log_time(record.get("ts"))
+    if filters["until"] and (ts is None or ts > filters["until"]):
+        return False
+    if filters["since"] and (ts is None or ts < filters["since"]):
+        return False
+    if filters["q"] and filters["q"] not in json.dumps(record, ensure_ascii=False).lower():
+        return False
+    return True
+
+
+def iter_lines_backwards(f, end, block_size=64 * 1024):
+    """Выдаёт (смещение начала строки, строка) от end к началу файла, читая блоками"""
+    pos = end
+    tail = b""
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + tail).split(b"\n")
+        tail = lines.pop(0)  # начало первой строки блока может быть в предыдущем блоке
+        cursor = pos + len(tail) + 1 + sum(len(line) + 1 for line in lines)
+        for line in reversed(lines):
+            cursor -= len(line) + 1
+            if line.strip():
+                yield cursor, line
+    if tail.strip():
+        yield 0, tail
+
+
+def read_log_page(before=None, limit=LOG_PAGE_SIZE, filters=None):
+    """Возвращает (записи по возрастанию времени, смещение для следующей страницы или None)"""
+    filters = filters or log_filters({})
+    if not os.path.exists(LOG_FILE):
+        return [], None
+    records = []
+    next_before = None
+    with open(LOG_FILE, "rb") as f:
+        end = os.fstat(f.fileno()).st_size if before is None else min(before, os.fstat(f.fileno()).st_size)
+        for offset, line in iter_lines_backwards(f, end):
+            next_before = offset
+            record = parse_log_line(line.decode("utf-8", errors="replace"))
+            ts = _log_time(record.get("ts"))
+            if filters["since"] and ts and ts < filters["since"]:
+                next_before = None  # дальше только более старые записи
+                break
+            if log_matches(record, filters):
+                record["offset"] = offset
+                records.append(record)
+                if len(records) >= limit:
+                    break
+            if end - offset > LOG_SCAN_LIMIT:
+                break  # вернём частичную страницу, продолжить можно с next_before
+    if next_before == 0:
+        next_before = None
+    records.reverse()
+    return records, next_before
+
+
 @app.route('/logs')
 def logs():
-    logs = ""
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r', encoding="utf-8", errors="replace") as f:
-            logs = f.read()
+    filters = log_filters(request.args)
+    before = request.args.get("before", type=int)
+    records, next_before = read_log_page(before, filters=filters)
+    return render_template("logs.html", records=records, next_before=next_before,
+                           args=request.args, levels=LOG_LEVELS)
+
+
+@app.route('/logs/api')
+def logs_api():
+    filters = log_filters(request.args)
+    limit = min(request.args.get("limit", LOG_PAGE_SIZE, type=int), 1000)
+    records, next_before = read_log_page(request.args.get("before", type=int), limit, filters)
+    return jsonify(records=records, next_before=next_before)
+
+
+@app.route('/logs/stream')
+def logs_stream():
+    """Server-sent events: новые записи лога по мере появления"""
+    filters = log_filters(request.args)
+    start = request.headers.get("Last-Event-ID", type=int)
+
+    def follow():
+        position = start
+        inode = None
+        buffer = b""
+        idle = 0
+        while True:
+            try:
+                stat = os.stat(LOG_FILE)
+            except FileNotFoundError:
+                time.sleep(1)
+                continue
+            if position is None:
+                position = stat.st_size  # подключение без Last-Event-ID: только новые записи
+            if inode is not None and (stat.st_ino != inode or stat.st_size < position):
+                position, buffer = 0, b""  # файл ротирован — читаем новый с начала
+            inode = stat.st_ino
+            if stat.st_size > position:
+                with open(LOG_FILE, "rb") as f:
+                    f.seek(position)
+                    data = f.read(stat.st_size - position)
+                line_end = position - len(buffer)
+                position += len(data)
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()  # незаконченная строка дописывается ботом
+                for line in lines:
+                    line_end += len(line) + 1
+                    if not line.strip():
+                        continue
+                    record = parse_log_line(line.decode("utf-8", errors="replace"))
+                    if log_matches(record, filters):
+                        # id — смещение после строки: браузер продолжит с него после переподключения
+                        yield f"id: {line_end}\ndata: {json.dumps(record, ensure_ascii=False)}\n\n"
+                idle = 0
+            else:
+                idle += 1
+                if idle >= 15:
+                    idle = 0
+                    yield ": ping\n\n"  # держим соединение и замечаем отключение клиента
+            time.sleep(1)
 
-    return render_template("logs.html", logs=logs)
+    return Response(follow(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.route('/bot_console', methods=['GET', 'POST'])
 def bot_console():